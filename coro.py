@@ -0,0 +1,242 @@
+import os
+import sys
+import time
+import types
+import heapq
+import select
+import threading
+import collections
+
+# Minimal coroutine loop, in the spirit of asyncio but for python 2:
+# a coroutine is a generator. It can yield:
+#
+#  - a Future, to wait until the future is set; the value of the
+#    future is sent back into the generator;
+#  - another generator, to call it as a sub-coroutine;
+#  - Return(v), to terminate and send v back to its caller;
+#  - None, to let the other coroutines run.
+#
+# Exceptions raised in a sub-coroutine propagate to its caller.
+
+class Future(object):
+    __slots__ = ('done', 'value', 'callbacks')
+
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.callbacks = []
+
+    def __repr__(self):
+        return '<Future %s>' % ['pending', 'done: %r' % (self.value,)][self.done]
+
+    def set(self, value = None):
+        if self.done:
+            return
+        self.done = True
+        self.value = value
+        cbs = self.callbacks
+        self.callbacks = []
+        for cb in cbs:
+            cb(value)
+
+    # so that a future can stand in for a condition variable
+    # as the waiter of a container
+    def notify(self):
+        self.set()
+
+    def addCallback(self, cb):
+        if self.done:
+            cb(self.value)
+        else:
+            self.callbacks.append(cb)
+
+class Return(object):
+    __slots__ = ('value',)
+
+    def __init__(self, value = None):
+        self.value = value
+
+class Loop(object):
+
+    def __init__(self):
+        self.ready = collections.deque()
+        self.ntasks = 0
+        self.timers = []
+        self.timerseq = 0
+        self.readers = {}
+        self.writers = {}
+        # results from other threads, and the pipe that wakes up select()
+        self.incoming = collections.deque()
+        self.nthreads = 0
+        self.wakeread, self.wakewrite = os.pipe()
+
+    def __repr__(self):
+        return '<Loop %d tasks, %d ready>' % (self.ntasks, len(self.ready))
+
+    def close(self):
+        os.close(self.wakeread)
+        os.close(self.wakewrite)
+
+    def spawn(self, gen):
+        self.ntasks += 1
+        self.ready.append(([gen], None, None))
+
+    def resume(self, task):
+        return lambda value: self.ready.append((task, value, None))
+
+    def step(self, task, value, exc):
+        # run one task until it suspends or terminates
+        while True:
+            gen = task[-1]
+            try:
+                if exc is not None:
+                    e, exc = exc, None
+                    y = gen.throw(*e)
+                else:
+                    y = gen.send(value)
+            except StopIteration:
+                y = Return()
+            except:
+                task.pop()
+                if len(task) == 0:
+                    self.ntasks -= 1
+                    raise
+                exc = sys.exc_info()
+                continue
+
+            value = None
+            if isinstance(y, types.GeneratorType):
+                task.append(y)
+            elif isinstance(y, Return):
+                task.pop().close()
+                if len(task) == 0:
+                    self.ntasks -= 1
+                    return
+                value = y.value
+            elif isinstance(y, Future):
+                if y.done:
+                    value = y.value
+                else:
+                    y.addCallback(self.resume(task))
+                    return
+            elif y is None:
+                self.ready.append((task, None, None))
+                return
+            else:
+                exc = (TypeError, TypeError('coroutine yielded %r' % (y,)), None)
+
+    def run(self):
+        while self.ntasks > 0:
+            while len(self.ready) > 0:
+                task, value, exc = self.ready.popleft()
+                self.step(task, value, exc)
+            if self.ntasks > 0:
+                self.poll()
+
+    def poll(self):
+        # wait for a timer, file descriptor or thread to make progress
+        if len(self.timers) == 0 and len(self.readers) == 0 and \
+           len(self.writers) == 0 and self.nthreads == 0:
+            raise RuntimeError('all coroutines are blocked')
+
+        timeout = None
+        if len(self.timers) > 0:
+            timeout = max(0, self.timers[0][0] - time.time())
+
+        r, w, x = select.select(self.readers.keys() + [self.wakeread],
+                                self.writers.keys(), [], timeout)
+
+        for fd in r:
+            if fd == self.wakeread:
+                os.read(self.wakeread, 4096)
+            else:
+                self.readers.pop(fd).set()
+        for fd in w:
+            self.writers.pop(fd).set()
+
+        now = time.time()
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            heapq.heappop(self.timers)[2].set()
+
+        while len(self.incoming) > 0:
+            f, value = self.incoming.popleft()
+            self.nthreads -= 1
+            f.set(value)
+
+    # ---- awaitables ----
+
+    def sleep(self, delay):
+        f = Future()
+        self.timerseq += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.timerseq, f))
+        return f
+
+    def readable(self, fd):
+        # one waiter per file descriptor
+        assert fd not in self.readers
+        f = self.readers[fd] = Future()
+        return f
+
+    def writable(self, fd):
+        assert fd not in self.writers
+        f = self.writers[fd] = Future()
+        return f
+
+    def runInThread(self, func, *args):
+        # run a blocking call in a separate thread; the future is
+        # set with its result (exceptions are returned, not raised).
+        f = Future()
+        self.nthreads += 1
+
+        def run():
+            try:
+                value = func(*args)
+            except Exception, e:
+                value = e
+            self.incoming.append((f, value))
+            os.write(self.wakewrite, 'x')
+
+        t = threading.Thread(target = run)
+        t.daemon = True
+        t.start()
+        return f
+
+# the loop of the running network; box code uses the
+# module-level functions below.
+loop = None
+
+def runLoop(gen):
+    global loop
+    loop = Loop()
+    try:
+        loop.spawn(gen)
+        loop.run()
+    finally:
+        loop.close()
+        loop = None
+
+def spawn(gen):
+    loop.spawn(gen)
+
+def sleep(delay):
+    return loop.sleep(delay)
+
+def readable(fd):
+    return loop.readable(fd)
+
+def writable(fd):
+    return loop.writable(fd)
+
+def runInThread(func, *args):
+    return loop.runInThread(func, *args)
+
+__all__ = [
+    'Future',
+    'Return',
+    'runLoop',
+    'spawn',
+    'sleep',
+    'readable',
+    'writable',
+    'runInThread'
+]
@@ -0,0 +1,161 @@
+import os
+import time
+import struct
+import atexit
+import threading
+import collections
+
+# Structured trace events, for post-mortem analysis with tracetool.py.
+#
+# Each event is a fixed-size binary record: timestamp, operation,
+# container id, input record number, pos, pli and an argument (a box
+# id for box events). Box names are recorded once, in EV_NAME events
+# followed by the name.
+#
+# HYDRA_EVENTS=<file> writes all the events to a file.
+# HYDRA_EVENTS_RING=N keeps the last N events in memory instead;
+# writeEvents(<file>) saves them.
+#
+# Hot paths test "if evlog.on:" before calling evlog.emit().
+
+EV_NAME = 0      # arg: box id, followed by the box name
+EV_INPUT = 1     # a record was read
+EV_INSERT = 2    # insertContainer: a new container after this one
+EV_BOXIN = 3     # a box starts on the record of the container (arg: box id)
+EV_BOXOUT = 4    # the box returned (arg: box id)
+EV_FIRST = 5     # markAsFirst
+EV_DONE = 6      # markAsDone
+EV_PLI = 7       # propagatePli
+EV_STORE = 8     # storeRec: a record waits in a sync state
+EV_COMBINE = 9   # combineSyncMatches: a sync state fired
+EV_OUTPUT = 10   # the record was written
+
+opnames = ['name', 'input', 'insert', 'boxin', 'boxout', 'first', 'done',
+           'pli', 'store', 'combine', 'output']
+
+# timestamp, op, container id, inseq (64 bits: it counts all the
+# input records), pos, pli, arg
+evformat = struct.Struct('<dBQQiiI')
+nameformat = struct.Struct('<H')
+
+class EventLog(object):
+
+    def __init__(self):
+        self.on = False
+        self.events = collections.deque()
+        self.lock = threading.Lock()
+        self.f = None
+        self.boxnames = []
+
+    def __repr__(self):
+        return '<EventLog %s, %d events buffered>' % (['off', 'on'][self.on], len(self.events))
+
+    def start(self, path = None, ring = None):
+        # path: stream the events to this file; ring: keep the
+        # last ring events in memory
+        self.stop()
+        if path is not None:
+            self.f = open(path, 'wb')
+            self.events = collections.deque()
+            for boxid, name in enumerate(self.boxnames):
+                self.writeName(boxid, name)
+        else:
+            self.events = collections.deque(maxlen = ring)
+        self.on = True
+
+    def stop(self):
+        self.on = False
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+    def emit(self, op, c, arg = 0):
+        self.events.append(evformat.pack(time.time(), op, id(c), c.inseq,
+                                         getattr(c, 'pos', -1), getattr(c, 'pli', -1), arg))
+        if self.f is not None and len(self.events) >= 4096:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.f is None:
+                return
+            events = self.events
+            data = []
+            while len(events) > 0:
+                data.append(events.popleft())
+            self.f.write(''.join(data))
+            self.f.flush()
+
+    def writeName(self, boxid, name):
+        self.events.append(evformat.pack(time.time(), EV_NAME, 0, 0, 0, 0, boxid)
+                           + nameformat.pack(len(name)) + name)
+
+    def boxId(self, name):
+        boxid = len(self.boxnames)
+        self.boxnames.append(name)
+        if self.on:
+            self.writeName(boxid, name)
+        return boxid
+
+    def save(self, path):
+        # write the events kept in the ring buffer
+        with open(path, 'wb') as f:
+            for boxid, name in enumerate(self.boxnames):
+                f.write(evformat.pack(0, EV_NAME, 0, 0, 0, 0, boxid)
+                        + nameformat.pack(len(name)) + name)
+            for e in list(self.events):
+                if ord(e[8]) != EV_NAME:
+                    f.write(e)
+
+evlog = EventLog()
+
+if os.getenv('HYDRA_EVENTS'):
+    evlog.start(path = os.getenv('HYDRA_EVENTS'))
+elif os.getenv('HYDRA_EVENTS_RING'):
+    evlog.start(ring = int(os.getenv('HYDRA_EVENTS_RING')))
+
+atexit.register(evlog.stop)
+
+def startEvents(path = None, ring = 100000):
+    evlog.start(path, ring)
+
+def stopEvents():
+    evlog.stop()
+
+def writeEvents(path):
+    evlog.save(path)
+
+def boxId(name):
+    # a number for the box, recorded with its name in the trace
+    return evlog.boxId(name)
+
+def readEvents(f):
+    # generate (time, op, cid, inseq, pos, pli, arg[, name]) tuples
+    while True:
+        data = f.read(evformat.size)
+        if len(data) < evformat.size:
+            return
+        ev = evformat.unpack(data)
+        if ev[1] == EV_NAME:
+            n, = nameformat.unpack(f.read(nameformat.size))
+            ev += (f.read(n),)
+        yield ev
+
+__all__ = [
+    'EV_INPUT',
+    'EV_INSERT',
+    'EV_BOXIN',
+    'EV_BOXOUT',
+    'EV_FIRST',
+    'EV_DONE',
+    'EV_PLI',
+    'EV_STORE',
+    'EV_COMBINE',
+    'EV_OUTPUT',
+    'evlog',
+    'startEvents',
+    'stopEvents',
+    'writeEvents',
+    'boxId'
+]
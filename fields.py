@@ -0,0 +1,586 @@
+import types
+import functools
+import threading
+import itertools
+from logging import tracer
+from typedb import *
+from typedb import bufferView
+
+# The field database (see docs/langif.rst, "Environment-managed API").
+#
+# Record fields can hold plain python values, or references to data
+# managed by the environment. A reference (fieldref) is an opaque
+# integer naming an entry of the database; the entries are reference
+# counted, so that several records can share the same data without
+# copying it: control entities (synchrocells, the output) use copyref()
+# instead of duplicating the data, and release() deallocates the data
+# with its last reference.
+#
+# The data itself is managed by the concrete type of the field (see
+# typedb.py): allocated, cloned and deallocated by environment-managed
+# types, captured with wrap() and reference counted by the language
+# for language-managed ones.
+#
+# The BYTES_* types are buffers: access() returns a memoryview of the
+# logical size, so boxes read and write the data in place, and wrap()
+# takes any buffer (str, bytearray, mmap, or a memoryview slice of
+# another field) without copying it.
+#
+# Only the data allocated by the database can be written: that
+# captured by wrap() remains the caller's, and may be aliased
+# elsewhere, so access() reports it as read-only like shared data;
+# a box that needs to modify it clones it first.
+#
+# Box functions reach the database through their outf argument, a
+# BoxIO: outf(rec) outputs a record, outf.new() etc. manage fields.
+#
+# packRecs() serializes the fields of a batch of records into one
+# buffer, for another process; unpackRecs() makes new fields there.
+
+class fieldref(int):
+    # a reference to an entry of the field database; 0 is the null
+    # reference.
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<field %d>' % self
+
+class Field(object):
+    # size: logical size, realsize: allocated size, refs: number
+    # of references, owned: whether the data was allocated by the
+    # database (not wrapped)
+    __slots__ = ('data', 'size', 'type', 'realsize', 'refs', 'owned')
+
+    def __init__(self, data, size, typeid, realsize, owned):
+        self.data = data
+        self.size = size
+        self.type = typeid
+        self.realsize = realsize
+        self.refs = 1
+        self.owned = owned
+
+    def writable(self):
+        return self.refs == 1 and self.owned
+
+    def __repr__(self):
+        return '<Field type %d, size %d/%d, %d refs>' % (self.type, self.size, self.realsize, self.refs)
+
+# --------- the database -------
+
+class FieldDB(object):
+    # The methods follow the io_cb API of langif.h, without the io_cb
+    # argument. Return values:
+    #   access, getmd: 1 if the data is writable (one reference to
+    #     data owned by the database), 0 if it is read-only (shared,
+    #     or wrapped), -1 if the reference is invalid
+    #   resize: 0 on success, 1 if the data is read-only,
+    #     -1 if the reference is invalid or the size does not fit
+    #   new, clone, wrap, copyref: a reference, or 0 on failure
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fields = {}
+        self.ids = itertools.count(1)
+        # set by the first allocation, hot paths test "if fielddb.used:"
+        self.used = False
+        # allocated bytes, current and maximum
+        self.allocated = 0
+        self.highwater = 0
+
+    def __repr__(self):
+        return '<FieldDB %d fields, %d bytes>' % (len(self.fields), self.allocated)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def add(self, data, size, typeid, realsize, owned):
+        ref = fieldref(next(self.ids))
+        with self.lock:
+            self.fields[ref] = Field(data, size, typeid, realsize, owned)
+            self.allocated += realsize
+            if self.allocated > self.highwater:
+                self.highwater = self.allocated
+        self.used = True
+        return ref
+
+    def new(self, size, typeid):
+        t = concreteType(typeid)
+        if t is None or t.ema is None:
+            return fieldref(0)
+        data, realsize = t.allocate(size)
+        if data is None:
+            return fieldref(0)
+        return self.add(data, size, typeid, realsize, True)
+
+    def wrap(self, typeid, size, data):
+        # capture existing data, without copying it
+        return self.capture(typeid, size, data, False)
+
+    def capture(self, typeid, size, data, owned):
+        # wrap, owned: whether the data can be written in place (it
+        # is not referenced outside of the field)
+        t = concreteType(typeid)
+        if t is None:
+            return fieldref(0)
+        if t.lma is not None:
+            t.incref(data)
+        return self.add(data, size, typeid, size, owned)
+
+    def release(self, ref):
+        with self.lock:
+            f = self.fields.get(ref)
+            if f is None:
+                raise ValueError('invalid field reference %d' % ref)
+            f.refs -= 1
+            last = f.refs == 0
+            if last:
+                del self.fields[ref]
+                self.allocated -= f.realsize
+        t = concreteType(f.type)
+        if t.lma is not None:
+            t.decref(f.data)
+        elif last:
+            t.deallocate(f.size, f.data)
+
+    def copyref(self, ref):
+        with self.lock:
+            f = self.fields.get(ref)
+            if f is None:
+                return fieldref(0)
+            f.refs += 1
+        t = concreteType(f.type)
+        if t.lma is not None:
+            t.incref(f.data)
+        return ref
+
+    def access(self, ref):
+        # -> (rw, data); data is a memoryview for the BYTES_* types
+        f = self.fields.get(ref)
+        if f is None:
+            return -1, None
+        if concreteType(f.type).buffered:
+            view = bufferView(f.data)[:f.size]
+            return int(f.writable() and not view.readonly), view
+        return int(f.writable()), f.data
+
+    def getmd(self, ref):
+        # -> (rw, size, typeid, realsize)
+        f = self.fields.get(ref)
+        if f is None:
+            return -1, 0, 0, 0
+        rw = f.writable()
+        if rw and concreteType(f.type).buffered:
+            rw = not bufferView(f.data).readonly
+        return int(rw), f.size, f.type, f.realsize
+
+    def clone(self, ref):
+        f = self.fields.get(ref)
+        if f is None:
+            return fieldref(0)
+        t = concreteType(f.type)
+        if t.ema is None:
+            return fieldref(0)
+        data = t.clone(f.size, f.data)
+        # the clone callback does not return its allocated size: that
+        # of a buffer is its length (for the BYTES_* types, the size
+        # rounded up to the alignment)
+        realsize = len(data) if t.buffered else f.size
+        return self.add(data, f.size, f.type, realsize, True)
+
+    def resize(self, ref, newsize):
+        with self.lock:
+            f = self.fields.get(ref)
+            if f is None or newsize > f.realsize:
+                return -1
+            if not f.writable():
+                return 1
+            f.size = newsize
+            return 0
+
+fielddb = FieldDB()
+
+# --------- records -------
+
+def recRefs(rec):
+    # the references held by a record
+    return [v for v in rec.itervalues() if type(v) is fieldref]
+
+def releaseRec(rec):
+    # drop the references held by a record that is discarded
+    for v in rec.itervalues():
+        if type(v) is fieldref:
+            fielddb.release(v)
+
+def derefRec(rec):
+    # a copy of the record with the referenced data instead of the
+    # references (bytes types: the logical size), or the record
+    # itself if it holds none.
+    if len(recRefs(rec)) == 0:
+        return rec
+    r = type(rec)(rec)
+    for k, v in rec.iteritems():
+        if type(v) is fieldref:
+            rw, data = fielddb.access(v)
+            if type(data) is memoryview:
+                data = data.tobytes()
+            r[k] = data
+    return r
+
+class packedref(int):
+    # in a record packed by packRecs: the index of a field in the
+    # packed buffer
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<packed field %d>' % self
+
+def packRecs(recs):
+    # -> (recs, fields, buf): copies of the records with each reference
+    # replaced by a packedref, the (typeid, offset, length) of each
+    # distinct field, and the data of the fields serialized in one
+    # buffer. The buffer is allocated once from the conservative
+    # sizes of getsersize(), and the fields are serialized in place.
+    # Records without fields are not copied.
+    index = {}
+    todo = []
+    packed = []
+    for rec in recs:
+        if len(recRefs(rec)) == 0:
+            packed.append(rec)
+            continue
+        r = type(rec)(rec)
+        for k, v in rec.iteritems():
+            if type(v) is fieldref:
+                i = index.get(v)
+                if i is None:
+                    i = index[v] = len(todo)
+                    f = fielddb.fields[v]
+                    t = concreteType(f.type)
+                    size = f.size if t.ema is not None else 0
+                    todo.append((t, size, f.data, t.getsersize(size, f.data)))
+                r[k] = packedref(i)
+        packed.append(r)
+
+    if len(todo) == 0:
+        return packed, (), None
+
+    buf = bytearray(sum((est for t, size, data, est in todo)))
+    view = memoryview(buf)
+    fields = []
+    offset = 0
+    for t, size, data, est in todo:
+        n = t.serialize(size, data, view[offset:offset + est])
+        if n < 0 or n > est:
+            raise ValueError('cannot serialize a field of type %r' % t)
+        fields.append((t.typeid, offset, n))
+        offset += n
+    del view
+    del buf[offset:]
+    return packed, fields, buf
+
+def unpackRecs(recs, fields, buf):
+    # the records packed by packRecs, updated in place with new
+    # references to new fields. Environment-managed types with
+    # getdesersize() are deserialized in fields allocated beforehand,
+    # the others capture what deserialize() returns.
+    if len(fields) == 0:
+        return recs
+
+    view = memoryview(buf)
+    refs = []
+    for typeid, offset, n in fields:
+        t = concreteType(typeid)
+        src = view[offset:offset + n]
+        size = None
+        if t.ema is not None:
+            size = t.getdesersize(src)
+        ref = fieldref(0)
+        if size is not None:
+            ref = fielddb.new(size, typeid)
+        if ref != 0:
+            rw, data = fielddb.access(ref)
+            newdata, objsize = t.deserialize(src, data)
+            if newdata is data:
+                if fielddb.resize(ref, objsize) != 0:
+                    # the size does not fit: drop the fields made so far
+                    for r in refs + [ref]:
+                        fielddb.release(r)
+                    raise ValueError('cannot deserialize %d bytes in a field of type %r of size %d'
+                                     % (objsize, t, size))
+                refs.append(ref)
+                continue
+            fielddb.release(ref)
+        else:
+            newdata, objsize = t.deserialize(src, None)
+        # the data is the field's alone
+        ref = fielddb.capture(typeid, objsize, newdata, True)
+        if t.lma is not None:
+            # capture took its own reference
+            t.decref(newdata)
+        refs.append(ref)
+
+    # the first field to use a reference takes it, the others copy it
+    taken = [False] * len(refs)
+    unpacked = []
+    for rec in recs:
+        for k, v in rec.items():
+            if type(v) is packedref:
+                if taken[v]:
+                    rec[k] = fielddb.copyref(refs[v])
+                else:
+                    rec[k] = refs[v]
+                    taken[v] = True
+        unpacked.append(rec)
+    return unpacked
+
+# --------- boxes -------
+
+boxtrace = tracer('box')
+
+class BoxIO(functools.partial):
+    # The io_cb of one box invocation: calling it outputs a record,
+    # the methods are those of FieldDB except copyref.
+    #
+    # As in langif.rst ("Solution"), the references of the input
+    # record and those created by new, clone and wrap go on a cleanup
+    # list, released when the box ends. release() drops a reference
+    # early and also removes it from the list, so a box that loops
+    # over its outputs can free them as it goes. The list counts the
+    # occurrences of each reference, as the same one can appear in
+    # several fields of the input.
+    #
+    # The output takes its own reference to each field of an output
+    # record, so a box can output the same reference several times.
+    #
+    # A BoxIO is a functools.partial of outputRec(outf), so that
+    # creating one and calling it do not execute any python code
+    # besides outputRec itself: boxes that do not use fields pay
+    # little for it.
+
+    cleanup = None
+
+    def __repr__(self):
+        return '<BoxIO %d on cleanup list>' % sum((self.cleanup or {}).itervalues())
+
+    def take(self, rec):
+        # the references of the input record
+        for v in rec.itervalues():
+            if type(v) is fieldref:
+                self.remember(v)
+
+    def remember(self, ref):
+        if ref != 0:
+            if self.cleanup is None:
+                self.cleanup = {}
+            self.cleanup[ref] = self.cleanup.get(ref, 0) + 1
+        return ref
+
+    def finish(self):
+        # the box has ended
+        cleanup = self.cleanup
+        self.cleanup = None
+        if cleanup is not None:
+            for ref, n in cleanup.iteritems():
+                for i in xrange(n):
+                    fielddb.release(ref)
+
+    def log(self, level, fmt, *args):
+        boxtrace.log(level, fmt, *args)
+
+    def new(self, size, typeid):
+        return self.remember(fielddb.new(size, typeid))
+
+    def clone(self, ref):
+        return self.remember(fielddb.clone(ref))
+
+    def wrap(self, typeid, size, data):
+        return self.remember(fielddb.wrap(typeid, size, data))
+
+    def release(self, ref):
+        cleanup = self.cleanup
+        if cleanup is not None and ref in cleanup:
+            if cleanup[ref] == 1:
+                del cleanup[ref]
+            else:
+                cleanup[ref] -= 1
+        fielddb.release(ref)
+
+    def access(self, ref):
+        return fielddb.access(ref)
+
+    def getmd(self, ref):
+        return fielddb.getmd(ref)
+
+    def resize(self, ref, newsize):
+        return fielddb.resize(ref, newsize)
+
+def outputRec(outf, rec):
+    if fielddb.used:
+        for v in rec.itervalues():
+            if type(v) is fieldref:
+                fielddb.copyref(v)
+    outf(rec)
+
+def cleanupBox(f):
+    # run each invocation of a box function with a BoxIO, and
+    # release its cleanup list when the box ends. Fused boxes (see
+    # compileNet) already run each stage this way.
+    if getattr(f, 'fused', False):
+        return f
+
+    def cleanf(outf, rec):
+        io = BoxIO(outputRec, outf)
+        if fielddb.used:
+            io.take(rec)
+        res = f(io, rec)
+        if isinstance(res, types.GeneratorType):
+            # a coroutine box: clean up when it has finished
+            return cleanupgen(io, res)
+        if io.cleanup is not None:
+            io.finish()
+        return res
+
+    cleanf.__name__ = f.__name__
+    cleanf.__dict__.update(f.__dict__)
+    return cleanf
+
+def cleanupgen(io, gen):
+    yield gen
+    io.finish()
+
+if __name__ == "__main__":
+    import mmap
+    import ctypes
+
+    a = fielddb.new(10, BYTES_CACHE_ALIGNED)
+    assert fielddb.getmd(a) == (1, 10, BYTES_CACHE_ALIGNED, 64)
+    rw, data = fielddb.access(a)
+    data[0:5] = 'hello'
+
+    # shared: read-only until the copy is released
+    b = fielddb.copyref(a)
+    assert b == a and fielddb.access(a)[0] == 0
+    assert fielddb.resize(a, 5) == 1
+    fielddb.release(b)
+    assert fielddb.resize(a, 5) == 0
+    assert fielddb.resize(a, 100) == -1
+
+    c = fielddb.clone(a)
+    assert c != a and fielddb.access(c)[0] == 1
+    assert derefRec({'x' : a, 'y' : 1}) == {'x' : 'hello', 'y' : 1}
+
+    fielddb.release(a)
+    fielddb.release(c)
+    assert len(fielddb) == 0 and fielddb.allocated == 0
+    assert fielddb.access(a) == (-1, None) and fielddb.copyref(a) == 0
+
+    # a clone allocates for the logical size only
+    a = fielddb.new(200, BYTES_CACHE_ALIGNED)
+    fielddb.resize(a, 5)
+    c = fielddb.clone(a)
+    assert fielddb.getmd(c) == (1, 5, BYTES_CACHE_ALIGNED, 64)
+    assert fielddb.allocated == 256 + 64
+    fielddb.release(a)
+    fielddb.release(c)
+
+    # alignment of the buffers
+    for typeid, align in ((BYTES_SCALAR_ALIGNED, 16), (BYTES_CACHE_ALIGNED, 64),
+                          (BYTES_PAGE_ALIGNED, mmap.PAGESIZE)):
+        refs = [fielddb.new(n, typeid) for n in (1, 100, 5000)]
+        for r in refs:
+            assert ctypes.addressof(fielddb.fields[r].data) % align == 0
+            fielddb.release(r)
+
+    # wrap: slices of a field, and a map, share their data
+    a = fielddb.new(mmap.PAGESIZE, BYTES_PAGE_ALIGNED)
+    rw, data = fielddb.access(a)
+    data[0:11] = 'hello world'
+    b = fielddb.wrap(BYTES_UNALIGNED, 5, data[6:11])
+    fielddb.release(a)
+    data[6] = 'W'
+    assert derefRec({'x' : b}) == {'x' : 'World'}
+    fielddb.release(b)
+
+    # wrapped data is read-only, its clones are not
+    a = fielddb.wrap(BYTES_UNALIGNED, 5, bytearray('hello'))
+    assert fielddb.access(a)[0] == 0 and fielddb.getmd(a)[0] == 0
+    assert fielddb.resize(a, 2) == 1
+    b = fielddb.clone(a)
+    assert fielddb.access(b)[0] == 1 and fielddb.getmd(b)[0] == 1
+    fielddb.release(a)
+    fielddb.release(b)
+
+    m = mmap.mmap(-1, 100)
+    m[0:3] = 'abc'
+    a = fielddb.wrap(BYTES_UNALIGNED, 3, m)
+    assert fielddb.access(a)[1].tobytes() == 'abc'
+    fielddb.release(a)
+
+    # records in bulk, with a field shared by two records and one of
+    # a language-managed type: JSON lists, reference counted here
+    import json
+    counts = {}
+
+    def incref(ctx, typeid, data):
+        counts[id(data)] += 1
+
+    def decref(ctx, typeid, data):
+        counts[id(data)] -= 1
+        return int(counts[id(data)] == 0)
+
+    def jsonsize(ctx, typeid, objsize, data):
+        return 2 + sum((len(str(x)) + 2 for x in data))
+
+    def jsonser(ctx, typeid, objsize, data, dstbuf):
+        s = json.dumps(data)
+        dstbuf[:len(s)] = s
+        return len(s)
+
+    def jsondesersize(ctx, typeid, srcbuf):
+        # not used: the data of a language-managed type is not
+        # allocated by the database
+        return len(srcbuf)
+
+    def jsondeser(ctx, typeid, srcbuf, data):
+        assert data is None
+        data = json.loads(srcbuf.tobytes())
+        counts[id(data)] = 1
+        return data, 0
+
+    jsonlang = regLang(LangCB(getsersize = jsonsize, serialize = jsonser,
+                              getdesersize = jsondesersize, deserialize = jsondeser), 'json')
+    regLmaType(jsonlang, 100, 'json/list', LmaTypeCB(incref, decref, lambda ctx, t, d: len(d)))
+
+    a = fielddb.new(5, BYTES_UNALIGNED)
+    fielddb.access(a)[1][:] = 'hello'
+    l = [1, 22, 333]
+    counts[id(l)] = 1
+    b = fielddb.wrap(100, 0, l)
+    decref(None, 100, l)
+    recs = [{'x' : a, 'n' : 1}, {'x' : fielddb.copyref(a), 'l' : b}, {'n' : 2}]
+    packed = packRecs(recs)
+    assert packed[1] == [(BYTES_UNALIGNED, 0, 5), (100, 5, 12)]
+    for r in recs:
+        releaseRec(r)
+    assert len(fielddb) == 0 and counts[id(l)] == 0
+
+    recs = unpackRecs(*packed)
+    assert [derefRec(r) for r in recs] == [{'x' : 'hello', 'n' : 1},
+                                           {'x' : 'hello', 'l' : [1, 22, 333]}, {'n' : 2}]
+    assert recs[0]['x'] == recs[1]['x'] and fielddb.getmd(recs[0]['x'])[0] == 0
+    for r in recs:
+        releaseRec(r)
+    assert len(fielddb) == 0 and sum(counts.values()) == 0
+    print fielddb, 'highwater', fielddb.highwater
+
+__all__ = [
+    'fieldref',
+    'fielddb',
+    'recRefs',
+    'releaseRec',
+    'derefRec',
+    'packRecs',
+    'unpackRecs',
+    'BoxIO',
+    'cleanupBox'
+]
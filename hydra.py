@@ -9,21 +9,84 @@
 #   python hydra.py mult N
 #   #              (0 <= N <= 4)
 #
+#   # test the cleanup lists of the boxes: field memory high-water mark
+#   # of a looping box, without and with early release
+#   python hydra.py mult loop|looprel
+#
+#   # test zero-copy fields: slices of the input lines
+#   python hydra.py mult slices
+#
+#   # test fields in a CPU-bound box (set HYDRA_PROCS to run it in
+#   # worker processes)
+#   python hydra.py mult cpu
+#
 #   # test the sync implementation (Box+mult,Seq,Top,Sync)
 #   python hydra.py sync
 #
-# Optionally: set env var VERBOSE for details
+#   # test the hydra combinators (Box,Seq,Top,Sync,Par,Star,Bling)
+#   python hydra.py hydra par|star|bling
+#
+#   # test that records leaving a star early are not held back by
+#   # the others (eg. printf '4\n1\n2\n' with HYDRA_THREADS=8)
+#   python hydra.py hydra early
+#
+#   # test the coroutine backend (Box,Seq,Top,Sync + async)
+#   python hydra.py async mult|sync
+#
+#   # run a micro-benchmark (see the end of this file)
+#   python hydra.py bench <name>
+#
+# Optionally: set env var VERBOSE for details, or HYDRA_TRACE to trace
+# some subsystems only (eg. HYDRA_TRACE=sync,io=info) and
+# HYDRA_TRACE_SAMPLE=N to trace one in N input records.
+#
+# Optionally: set env var HYDRA_THREADS to the number of worker threads
+# to run continuations in parallel, and HYDRA_PROCS to the number of
+# worker processes for box functions declared @cpubound (there is then
+# at least one worker thread per process).
+#
+# Optionally: set env var HYDRA_EVENTS to a file name to record trace
+# events for tracetool.py.
+#
+# Optionally: set env var HYDRA_STATS to print performance counters at
+# exit, and HYDRA_STATS_INTERVAL to print them every so many seconds.
+#
+# Optionally: set env var HYDRA_CHUNKSIZE to the input read size in bytes
+# and HYDRA_DELIM to the input record delimiter (default: '\n').
+#
+# Optionally: set env var HYDRA_OUTPUT to the output format (repr, str,
+# json or frame), HYDRA_OUTBUF to the output buffer size in bytes and
+# HYDRA_FLUSHMS to the maximum delay before buffered output is written.
 
 import sys
 import os
+import threading
+import time
+import weakref
+import itertools
+import collections
+import types
 from colors import *
 from logging import *
-from fn import *
+from workers import *
+from streams import *
+from coro import *
+from events import *
+from stats import *
+from tc import *
+from typedb import *
+from fields import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # modes
 MODE_SEQ = 0
 MODE_MULT = 1
 MODE_SYNC = 2
+MODE_HYDRA = 3
 mode = MODE_SEQ
 
 if __name__ == "__main__":
@@ -35,20 +98,34 @@ if __name__ == "__main__":
         mode = MODE_MULT
     elif sys.argv[1] == "sync":
         mode = MODE_SYNC
+    elif sys.argv[1] == "hydra":
+        mode = MODE_HYDRA
+    elif sys.argv[1] == "async":
+        mode = [MODE_MULT, MODE_SYNC][sys.argv[2] == "sync"]
+    elif sys.argv[1] == "bench":
+        mode = MODE_MULT
 
 INFINITY = 10000
 
+# tracing subsystems besides 'core' (see logging.py)
+trio = tracer('io')
+trsync = tracer('sync')
+
+# marker for "no record", as None can be a valid box output
+nothing = object()
+
 def minindex(a, b):
     assert mode > MODE_SEQ
-    if mode <= MODE_SYNC:
-        # just compare numerically
+    if mode <= MODE_HYDRA:
+        # just compare numerically; C_hydra uses the
+        # indices of C_sync, see Par_hydra()
         return min(a,b)
     else:
         raise NotImplementedError
 
 def maxindex(a, b):
     assert mode > MODE_SEQ
-    if mode <= MODE_SYNC:
+    if mode <= MODE_HYDRA:
         # just compare numerically
         return max(a, b)
     else:
@@ -56,43 +133,137 @@ def maxindex(a, b):
 
 # --------- basic objets/functions
 
+# protects the links and the first/done/pos/pli fields of the
+# containers against concurrent updates by the worker threads.
+listlock = threading.Lock()
+
+# set when a continuation failed: the records still in the network
+# are given up, the threads waiting on a container (waiting) raise
+# WorkerFailed. Protected by listlock.
+aborted = False
+waiting = set()
+
+def abortWaits():
+    global aborted
+    with listlock:
+        aborted = True
+        for c in waiting:
+            c.waiter.notify()
+
+onWorkerFailure(abortWaits)
+
 # record = dict
 #   keys = types
 #   values = values
 
+# field names are interned to one bit each, so that a set of field
+# names (a record type, a pattern) is a single integer.
+
+fieldbits = {}
+fieldlock = threading.Lock()
+
+WORDMASK = (1 << 64) - 1
+
+def fieldBit(name):
+    b = fieldbits.get(name)
+    if b is None:
+        with fieldlock:
+            b = fieldbits.setdefault(name, 1 << len(fieldbits))
+    return b
+
+def fieldMask(names):
+    m = 0
+    for t in names:
+        m |= fieldBit(t)
+    return m
+
 class Rec(dict):
+    # sig: the fieldMask() of the keys, computed on demand and
+    # reset by every update of the keys.
+    __slots__ = ('sig',)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.sig = None
+
     def __repr__(self):
         return '%s%s%s' % (cGREEN, dict.__repr__(self), cNORMAL)
 
+    def __reduce__(self):
+        # pickled as its fields only: the bits of fieldBit() are
+        # only valid in this process, sig is computed again on demand
+        return (Rec, (dict(self),))
+
+    def signature(self):
+        sig = self.sig
+        if sig is None:
+            sig = self.sig = fieldMask(self)
+        return sig
+
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        self.sig = None
+
+    def __delitem__(self, k):
+        dict.__delitem__(self, k)
+        self.sig = None
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.sig = None
+
+    def setdefault(self, k, v = None):
+        self.sig = None
+        return dict.setdefault(self, k, v)
+
+    def pop(self, *args):
+        self.sig = None
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.sig = None
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self.sig = None
+
+def recSignature(rec):
+    if type(rec) == Rec:
+        return rec.signature()
+    return fieldMask(rec)
+
 class Container(object):
     #fields:
     #
     #  next: next in sub-stream sequence
     #  record: the record being referenced
     #
-    # MODE_SEQ:
-    #  first: True if container is the first (ie not a successor)
+    # waiter: condition variable (on listlock) used by the one thread
+    #  that waits for first/pli to change on this container, created
+    #  on demand.
+    # traced: whether the input record is traced (see logging.py)
+    # inseq: number of the input record, for trace events
+    # owner: the replicas (see Replica) whose network holds the
+    #  record, innermost first, as a (replica, outer owner) chain
     #
-    # MODE_MULT:
-    #  pli, pos: network indices
+    # The mode-specific fields and accessors are defined by the
+    # subclasses below; selectContainer() picks one when the network
+    # is built.
     #
+    # Released containers are kept on a free list per class and
+    # reused by newContainer(). With HYDRA_CHECKFREE (or VERBOSE) set,
+    # they are only marked as deleted instead, so that a use after
+    # free remains visible.
+
+    __slots__ = ('next', 'record', 'waiter', 'deleted', 'traced', 'inseq', 'owner')
 
     def __repr__(self):
         s = ''
         c = self
         while c is not None:
 
-            s += '[%r | ' % c.record
-
-            if mode <= MODE_MULT:
-                s += '%s' % ['succ', 'first'][int(c.first)]
-                if c.done:
-                    s += ' | %sDONE%s' % (cYELLOW, cNORMAL)
-            else: 
-                s += 'pos %s%r%s pli %s%r%s' % (cBLUE, c.pos, cNORMAL,
-                                                cBLUE, c.pli, cNORMAL,)
-                if c.pos == INFINITY:
-                    s += ' | %sDONE%s' % (cYELLOW, cNORMAL)                    
+            s += '[%r | %s' % (c.record, c.reprState())
 
             if c.deleted:
                 s += ' | %sdeleted%s' % (cRED, cNORMAL)
@@ -104,164 +275,365 @@ class Container(object):
     @informobjp(updater = True)
     def __init__(self):
         # createContainer
+        self.deleted = False
+        self.traced = True
+        self.inseq = 0
+        self.reset()
+
+    def reset(self):
         self.next = None
         self.record = None
-
-        if mode <= MODE_MULT:
-            self.first = False
-            self.done = False
-        else:
-            self.pos = 0
-            self.pli = 0
-
-        self.deleted = False
+        # a recycled container has no waiter: the condition or future
+        # of a previous run must not be notified
+        self.waiter = None
+        self.owner = None
 
     @informobjp(updater = True)
     def setRec(self, r):
+        assert not self.deleted
         self.record = r
 
     @informobj
     def freeContainer(self):
-        # in python nothing to do, just drop ref
-        # however for checking we will mark it as deleted
-        self.deleted = True
+        if checkfree:
+            # keep it around, marked as deleted for checking
+            self.deleted = True
+        elif len(self.freelist) < FREELIST_MAX:
+            self.reset()
+            self.freelist.append(self)
 
-    # ---- accessors in use for the "seq" impl ----
+    # ---- blocking handoff between threads ----
+    # both must be called with listlock held.
 
-    @informobjp(updater = True)
-    def markAsFirst(self):
-        if mode <= MODE_MULT:
-            self.first = True
-        else:
-            self.pli = INFINITY
+    @informobj
+    def waitUpdate(self):
+        # block until another thread updates first/pli on this
+        # container, or the network is aborted
+        if aborted:
+            raise WorkerFailed()
+        if self.waiter is None:
+            self.waiter = threading.Condition(listlock)
+        waiting.add(self)
+        self.waiter.wait()
+        waiting.discard(self)
+        if aborted:
+            raise WorkerFailed()
 
     @informobj
-    def isFirst(self):
-        if mode <= MODE_MULT:
-            return self.first
-        else:
-            return self.pli == INFINITY
+    def notifyUpdate(self):
+        if self.waiter is not None:
+            self.waiter.notify()
+
+    # ---- accessors in use for the "seq" impl ----
 
     @informobjp(updater = True)
     def propagateFirst(self):
         thenext = self.next
         while thenext.isDone():
+            done = thenext
             thenext = thenext.next
-            thenext.freeContainer()
+            done.freeContainer()
+        self.next = thenext
 
         thenext.markAsFirst()
 
+class FlagContainer(Container):
+    # MODE_SEQ, MODE_MULT:
+    #  first: True if container is the first (ie not a successor)
+    #  done: True if the record was consumed (MODE_MULT only)
+
+    __slots__ = ('first', 'done')
+    freelist = []
+
+    def reprState(self):
+        s = ['succ', 'first'][int(self.first)]
+        if self.done:
+            s += ' | %sDONE%s' % (cYELLOW, cNORMAL)
+        return s
+
+    def reset(self):
+        Container.reset(self)
+        self.first = False
+        self.done = False
+
     @informobjp(updater = True)
-    def markNextPos(self):
+    def markAsFirst(self):
+        assert not self.deleted
+        self.first = True
+        if evlog.on:
+            evlog.emit(EV_FIRST, self)
+        self.notifyUpdate()
 
-        assert not self.next.isDone()
+    @informobj
+    def isFirst(self):
+        return self.first
 
-        if mode <= MODE_MULT:
-            self.next.first = False
-        else:
-            self.next.pli = minindex(self.pli, self.pos)
+    @informobjp(updater = True)
+    def markNextPos(self):
+        assert not self.next.isDone()
+        self.next.first = False
 
     # ---- accessors in use for the "mult" impl ----
 
     @informobjp(updater = True)
     def markAsDone(self):
-        assert mode > MODE_SEQ
+        assert not self.isDone()
+
+        self.done = True
+        if evlog.on:
+            evlog.emit(EV_DONE, self)
+        if self.first:
+            # the head of the stream produced nothing: hand over
+            # to the successor, otherwise its writer waits forever.
+            self.propagateFirst()
+
+    @informobj
+    def isDone(self):
+        return self.done
+
+class IndexContainer(Container):
+    # MODE_SYNC, MODE_HYDRA:
+    #  pli, pos: network indices
+
+    __slots__ = ('pos', 'pli')
+    freelist = []
+
+    def reprState(self):
+        s = 'pos %s%r%s pli %s%r%s' % (cBLUE, self.pos, cNORMAL,
+                                       cBLUE, self.pli, cNORMAL,)
+        if self.pos == INFINITY:
+            s += ' | %sDONE%s' % (cYELLOW, cNORMAL)
+        return s
+
+    def reset(self):
+        Container.reset(self)
+        self.pos = 0
+        self.pli = 0
+
+    @informobjp(updater = True)
+    def markAsFirst(self):
+        assert not self.deleted
+        self.pli = INFINITY
+        if evlog.on:
+            evlog.emit(EV_FIRST, self)
+        self.notifyUpdate()
+
+    @informobj
+    def isFirst(self):
+        return self.pli == INFINITY
 
+    @informobjp(updater = True)
+    def markNextPos(self):
+        assert not self.next.isDone()
+        self.next.pos = self.pos
+        self.next.pli = minindex(self.pli, self.pos)
+
+    # ---- accessors in use for the "mult" impl ----
+
+    @informobjp(updater = True)
+    def markAsDone(self):
         assert not self.isDone()
 
-        if mode <= MODE_MULT:
-            self.done = True
-        else:
-            self.pos = INFINITY
+        self.pos = INFINITY
+        if evlog.on:
+            evlog.emit(EV_DONE, self)
+
+        # the record was consumed in its replicas
+        o = self.owner
+        while o is not None:
+            o[0].inflight -= 1
+            o = o[1]
+        self.owner = None
 
-            # " After the container at the head of the cons-list reaches its end, markAsDone propa- gates its pli-value to its successor. " (7.4.1)
+        # " After the container at the head of the cons-list reaches its end, markAsDone propa- gates its pli-value to its successor. " (7.4.1)
+        if self.pli == INFINITY:
+            self.propagateFirst()
+        else:
             self.next.pli = self.pli
-        
+            self.next.notifyUpdate()
+
     # ---- accessors in use for the "sync" impl ----
 
     @informobjp(updater = True)
     def posInc(self):
-        assert mode > MODE_SEQ
-        if mode <= MODE_SYNC:
-            self.pos = self.pos + 1
-        else:
-            raise NotImplementedError
+        self.pos = self.pos + 1
 
     @informobjp(updater = True)
     def propagatePli(self):
-        assert mode > MODE_MULT
-
         thenext = self.next
-        while thenext.done:
+        while thenext.isDone():
+            done = thenext
             thenext = thenext.next
-            thenext.freeContainer()
+            done.freeContainer()
+        self.next = thenext
 
         thenext.pli = self.pos
+        if evlog.on:
+            evlog.emit(EV_PLI, thenext)
+        thenext.notifyUpdate()
+
+    @informobjp(updater = True)
+    def propagatePos(self):
+        # the record moved on: raise the pli of the successors to the
+        # new lower bound of the positions of their predecessors, so
+        # that those waiting in handleSync do not wait for this record
+        # to reach the output. Stops at the first successor whose pli
+        # does not change.
+        pli = minindex(self.pli, self.pos)
+        thenext = self.next
+        while thenext is not None and thenext.pli < pli:
+            thenext.pli = pli
+            if evlog.on:
+                evlog.emit(EV_PLI, thenext)
+            thenext.notifyUpdate()
+            pli = minindex(pli, thenext.pos)
+            thenext = thenext.next
 
     @informobj
     def isDone(self):
-        if mode <= MODE_MULT:
-            return self.done
-        else:
-            return self.pos == INFINITY
+        return self.pos == INFINITY
+
+checkfree = bool(os.getenv('HYDRA_CHECKFREE') or os.getenv('VERBOSE'))
+FREELIST_MAX = 65536
+
+# the container class for the current mode
+containerclass = None
+
+def selectContainer():
+    # called when a network is built
+    global containerclass
+    if mode <= MODE_MULT:
+        containerclass = FlagContainer
+    elif mode <= MODE_HYDRA:
+        containerclass = IndexContainer
+    else:
+        raise NotImplementedError
+
+def newContainer():
+    # list.pop() is atomic, no lock needed
+    try:
+        return containerclass.freelist.pop()
+    except IndexError:
+        return containerclass()
 
 @inform
-def insertContainer(cont, c, r):
-    cp = Container()
+def linkContainer(c, r):
+    # give r to c and insert a fresh container after it
+    cp = newContainer()
+    # further outputs for the same input record
+    cp.traced = c.traced
+    cp.inseq = c.inseq
 
-    cp.next = c.next
-    c.next = cp
+    with listlock:
+        cp.next = c.next
+        c.next = cp
 
-    c.markNextPos()
+        c.markNextPos()
+
+        # one more record in the replicas of c
+        o = cp.owner = c.owner
+        while o is not None:
+            o[0].inflight += 1
+            o = o[1]
 
     c.setRec(r)
 
+    if evlog.on:
+        evlog.emit(EV_INSERT, c)
+
+    return cp
+
+@inform
+def insertContainer(cont, c, r):
+    cp = linkContainer(c, r)
+
     if not spawnThread(cont, c): 
         cont(c) 
 
     return cp
 
 
-@inform
+def inputRecord(insert, cont, t, line, inseq):
+    # the input record number inseq goes in t, the last container;
+    # insert is insertContainer or insertContainerAsync.
+    # -> the new last container
+    t.traced = sampleNext()
+    if trio.on and t.traced:
+        trio.debug("read input: %r", line)
+    t.inseq = inseq
+    if evlog.on:
+        evlog.emit(EV_INPUT, t)
+    return insert(cont, t, Rec({'str': line}))
+
+@informp(sub = 'io')
 def handleInput(cont):
+    global aborted
+    aborted = False
 
-    t = Container()
+    t = newContainer()
 
-    t.markAsFirst()
+    with listlock:
+        t.markAsFirst()
 
-    hasinput = True
-    while hasinput:
-        line = sys.stdin.readline()
-        if line == '':
-            hasinput = False
-        else:
-            log("read input: %r", line)
-            t = insertContainer(cont, t, Rec({'str': line}))
+    n = 0
+    try:
+        for batch in readBatches():
+            for line in batch:
+                n += 1
+                t = inputRecord(insertContainer, cont, t, line, n)
+    except:
+        # stop the continuations waiting for this one, and raise the
+        # error of a worker thread instead of WorkerFailed
+        abortWaits()
+        waitWorkers()
+        raise
+
+    trio.debug("read input: EOF")
 
-    log("read input: EOF")
-    
+    # wait for the continuations still running in the worker threads
+    waitWorkers()
+    flushOutput()
 
 @inform
 def spawnThread(cont, c):
-    # FIXME: for now inoperative
-    return False
+    # hand over cont(c) to an idle worker thread, if there is one.
+    # the container list ensures outputs are still produced in order.
+    return trySpawn(cont, c)
+
+# records: written, wait: time spent waiting for the predecessors
+outcounters = counters('output')
 
 def writeOutput(record):
-    print record
+    if fielddb.used:
+        # the data of the fields is written, then released
+        outputSink().write(derefRec(record))
+        releaseRec(record)
+    else:
+        outputSink().write(record)
 
-@inform
+@informp(sub = 'io')
 def handleOutput(c):
-    # FIXME: "wait until isFirst(c)"
-    while not c.isFirst():
-        # FIXME: maybe yield here somehow?
-        pass
+    # wait until isFirst(c); woken up by markAsFirst()
+    with listlock:
+        if not c.isFirst():
+            start = time.time()
+            while not c.isFirst():
+                c.waitUpdate()
+            if outcounters.on:
+                outcounters.addTime('wait', time.time() - start)
+    if outcounters.on:
+        outcounters.count('records')
 
     log("c = %r",  c)
 
+    if evlog.on:
+        evlog.emit(EV_OUTPUT, c)
+
     writeOutput(c.record)
 
-    c.propagateFirst()
-    c.freeContainer()
+    with listlock:
+        c.propagateFirst()
+        c.freeContainer()
 
     # simply return
 
@@ -280,12 +652,15 @@ def modifyRec(f, c):
     f(outf, c.record)
 
     c.record = d[0]
-    log("update rec: c -> %r" % c)
+    log("update rec: c -> %r", c)
 
     return leave(c)
 
 def Box_seq(f):
 
+    f = countBox(cleanupBox(offloadBox(f)))
+    boxid = boxId(f.__name__)
+
     @informp(f)
     def boxf(c):
 
@@ -299,7 +674,11 @@ def Box_seq(f):
             d[0] = r
 
         # call the box function
+        if evlog.on:
+            evlog.emit(EV_BOXIN, c, boxid)
         f(outf, c.record)
+        if evlog.on:
+            evlog.emit(EV_BOXOUT, c, boxid)
 
         # update the container
         c.setRec(d[0])
@@ -328,6 +707,8 @@ def Out_seq():
 
 def Top_seq(N):
 
+    selectContainer()
+
     @handletc
     @informp(N)
     def topf():
@@ -388,6 +769,9 @@ def Box_mult(f):
     # to avoid constructing a list with the output records;
     # this is needed to support boxes with "infinite" number of output records.
 
+    f = countBox(cleanupBox(offloadBox(f)))
+    boxid = boxId(f.__name__)
+
     @handletc
     @informp(f)
     def boxf(cont, c):
@@ -401,17 +785,25 @@ def Box_mult(f):
                 c = insertContainer(cont, c, prevrec[0])
             d[0:2] = (c, (r,))
 
+        if evlog.on:
+            evlog.emit(EV_BOXIN, c, boxid)
         f(outf, c.record)
+        if evlog.on:
+            # c may have moved on already, d[0] is still ours
+            evlog.emit(EV_BOXOUT, d[0], boxid)
         
         c, lastrec = d
         if lastrec is None:
-            c.markAsDone()
+            with listlock:
+                c.markAsDone()
             return
         else:
             c.setRec(lastrec[0])
 
             return tailcall(cont, c)
             
+    # for compileNet()
+    boxf.box = f
     return boxf
 
 def Seq_mult(N, M):
@@ -426,10 +818,74 @@ def Seq_mult(N, M):
 
         return tailcall(N, seqf_cont_N, c)
 
+    seqf.seq = (N, M)
     return seqf
 
+def onetoone(f):
+    # declare a box function as producing exactly one output
+    # record per input record. compileNet() fuses sequences of
+    # such boxes into a single box.
+    f.onetoone = True
+    return f
+
+def seqStages(N):
+    # the stages of a network, with nested Seq_mult flattened
+    if hasattr(N, 'seq'):
+        a, b = N.seq
+        return seqStages(a) + seqStages(b)
+    return [N]
+
+def fuseBoxes(fs):
+    # one box function that applies all of fs in sequence
+    def fusedf(outf, rec):
+        d = [None]
+        def setrec(r):
+            d[0] = r
+        for f in fs:
+            f(setrec, rec)
+            rec = d[0]
+        outf(rec)
+
+    fusedf.__name__ = '..'.join((f.__name__ for f in fs))
+    # the stages have their own cleanup lists
+    fusedf.fused = True
+    return onetoone(fusedf)
+
+@inform
+def compileNet(N):
+    # replace each run of one-to-one boxes in the sequences of
+    # N by a single box: the records then go from one box function
+    # to the next with a plain call, without containers or
+    # continuations in between. CPU-bound boxes are left alone,
+    # as they run in the process pool.
+    stages = []
+    run = []
+    for st in seqStages(N) + [None]:
+        f = getattr(st, 'box', None)
+        if f is not None and getattr(f, 'onetoone', False) \
+           and not getattr(f, 'cpubound', False):
+            run.append(st)
+            continue
+        if len(run) > 1:
+            log("fusing %s", ', '.join((r.box.__name__ for r in run)))
+            stages.append(Box_mult(fuseBoxes([r.box for r in run])))
+        else:
+            stages.extend(run)
+        run = []
+        if st is not None:
+            stages.append(st)
+
+    N = stages.pop()
+    while len(stages) > 0:
+        N = Seq_mult(stages.pop(), N)
+    return N
+
 def Top_mult(N):
 
+    selectContainer()
+
+    N = compileNet(N)
+
     @handletc
     @informp(N)
     def topf():
@@ -452,20 +908,25 @@ def Top_mult(N):
 @handletc
 @inform
 def handleMult(cont, c, res):
-
-    if len(res) == 0:
-        c.markAsDone()
+    # res can be any iterable. it is consumed one record behind:
+    # every record but the last is inserted in front of c, the
+    # last one continues in c. This is linear in the number of
+    # records and does not copy res.
+
+    prevrec = nothing
+    for r in res:
+        if prevrec is not nothing:
+            c = insertContainer(cont, c, prevrec)
+        prevrec = r
+
+    if prevrec is nothing:
+        with listlock:
+            c.markAsDone()
         return
 
-    elif len(res) == 1:
-        c.setRec(res[0])
-
-        return tailcall(cont, c)
-
-    else:
-        cp = insertContainer(cont, c, res[0])
+    c.setRec(prevrec)
 
-        return tailcall(handleMult, cont, cp, res[1:])
+    return tailcall(cont, c)
 
 
 # test code
@@ -490,16 +951,19 @@ if __name__ == "__main__" and sys.argv[1] == 'mult':
         outf(Rec({'str' : s['str'] + '2'}))
         outf(Rec({'str' : s['str'] + '3'}))
 
+    @onetoone
     @inform
     def stripnl(outf, s):
         # {str} -> {str}
         outf(Rec({'str' : s['str'].rstrip()}))
 
+    @onetoone
     @inform
     def wrapcolon(outf, s):
         # {str} -> {str}
         outf(Rec({'str' : ':' + s['str'] + ':'}))
 
+    @onetoone
     @inform
     def ident(outf, s):
         # {str} -> {str}
@@ -523,9 +987,92 @@ if __name__ == "__main__" and sys.argv[1] == 'mult':
     elif sys.argv[2] == '4':
         print "network = box(stripnl)..((box(dup)..box(wrapcolon))..box(dup))"
         net = Top_mult(Seq_mult(Box_mult(stripnl), Seq_mult(Seq_mult(Box_mult(dup), Box_mult(wrapcolon)), Box_mult(dup))))
+    elif sys.argv[2] in ('loop', 'looprel'):
+        # the looping box of langif.rst, without and with release:
+        # the fields it creates are freed when it ends, or as it goes
+        NLOOP = 1000
+        FIELDSIZE = 4096
+        early = sys.argv[2] == 'looprel'
+
+        @inform
+        def loop(outf, s):
+            # {str} -> {bytes}
+            for i in xrange(NLOOP):
+                f = outf.new(FIELDSIZE, BYTES_UNALIGNED)
+                outf(Rec({'bytes' : f}))
+                if early:
+                    outf.release(f)
+
+        @inform
+        def size(outf, s):
+            # {bytes} -> {str}
+            rw, n, typeid, realsize = outf.getmd(s['bytes'])
+            outf(Rec({'str' : '%d' % n}))
+
+        # the bound below holds when the continuations run inline
+        configureWorkers(threads = 0)
+        print "network = box(loop)..box(size)"
+        net = Top_mult(Seq_mult(Box_mult(loop), Box_mult(size)))
+    elif sys.argv[2] == 'slices':
+        # the output fields are slices of the input lines, which
+        # are never copied
+
+        @inform
+        def load(outf, s):
+            # {str} -> {bytes}
+            l = s['str'].rstrip()
+            outf(Rec({'bytes' : outf.wrap(BYTES_UNALIGNED, len(l), l)}))
+
+        @inform
+        def halves(outf, s):
+            # {bytes} -> {bytes}
+            rw, data = outf.access(s['bytes'])
+            n = len(data) // 2
+            outf(Rec({'bytes' : outf.wrap(BYTES_UNALIGNED, n, data[:n])}))
+            outf(Rec({'bytes' : outf.wrap(BYTES_UNALIGNED, len(data) - n, data[n:])}))
+
+        print "network = box(load)..box(halves)"
+        net = Top_mult(Seq_mult(Box_mult(load), Box_mult(halves)))
+    elif sys.argv[2] == 'cpu':
+        # with HYDRA_PROCS, the records go to the worker processes
+        # and back with their fields packed (see packRecs)
+
+        @inform
+        def fill(outf, s):
+            # {str} -> {bytes}
+            l = s['str'].rstrip()
+            f = outf.new(len(l), BYTES_CACHE_ALIGNED)
+            rw, data = outf.access(f)
+            data[:] = l
+            outf(Rec({'bytes' : f}))
+
+        @cpubound
+        def upper(outf, s):
+            # {bytes} -> {bytes}, in place unless shared
+            f = s['bytes']
+            rw, data = outf.access(f)
+            if not rw:
+                f = outf.clone(f)
+                rw, data = outf.access(f)
+            data[:] = data.tobytes().upper()
+            outf(Rec({'bytes' : f}))
+
+        print "network = box(fill)..box(upper)"
+        net = Top_mult(Seq_mult(Box_mult(fill), Box_mult(upper)))
 
     net()
 
+    if sys.argv[2] in ('loop', 'looprel', 'slices', 'cpu'):
+        # every field was released by the output
+        assert len(fielddb) == 0
+
+    if sys.argv[2] in ('loop', 'looprel'):
+        print >>sys.stderr, "field memory high-water mark: %d bytes" % fielddb.highwater
+        if early:
+            assert fielddb.highwater <= 2 * FIELDSIZE
+        else:
+            assert fielddb.highwater >= NLOOP * FIELDSIZE
+
 
 
 # -------- hydra C_{sync} -------
@@ -535,31 +1082,57 @@ class Pattern(tuple):
         return '{%s}' % ', '.join(self)
 
 def Box_sync(f):
+    # like Box_mult, this inlines handleMult() so that the output
+    # records are streamed into the container list as they are
+    # produced ("infinite" multiplicity).
+
+    f = countBox(cleanupBox(offloadBox(f)))
+    boxid = boxId(f.__name__)
+
     @handletc
     @informp(f)
     def boxf(cont, c):
-        # FIXME: unfold handleMult to handle infinite multiplicity here (like with _mult above)
 
-        recs = []
-        
+        # all outputs leave the box at the next position; the
+        # successors created by insertContainer inherit it.
+        c.posInc()
+
+        d = [c, None]
+
         @inform
         def outf(r):
-            recs.append(r)
+            c, prevrec = d
+            if prevrec is not None:
+                c = insertContainer(cont, c, prevrec[0])
+            d[0:2] = (c, (r,))
 
+        if evlog.on:
+            evlog.emit(EV_BOXIN, c, boxid)
         f(outf, c.record)
+        if evlog.on:
+            evlog.emit(EV_BOXOUT, d[0], boxid)
 
-        c.posInc()
+        c, lastrec = d
+        if lastrec is None:
+            with listlock:
+                c.markAsDone()
+            return
+        else:
+            c.setRec(lastrec[0])
 
-        return tailcall(handleMult, cont, c, recs) 
+            return tailcall(cont, c)
 
     return boxf
 
 def Sync_sync(K):
 
+    # each synchrocell owns its states
+    table = SyncTable(K)
+
     @handletc
-    @informp(K)
+    @informp(K, sub = 'sync')
     def syncf(cont, c):
-        return tailcall(handleSync, cont, c, K)
+        return tailcall(handleSync, cont, c, K, table)
 
     return syncf
 
@@ -580,6 +1153,8 @@ def Seq_sync(N, M):
 
 def Top_sync(N):
 
+    selectContainer()
+
     @handletc
     @informp(N)
     def topf():
@@ -600,7 +1175,7 @@ def Top_sync(N):
 
 class syncstate(object):
 
-    @informobjp(updater = True)
+    @informobjp(updater = True, sub = 'sync')
     def __init__(self, pos, K):
         self.pats = tuple(K.pats)
         slots = {}
@@ -611,6 +1186,7 @@ class syncstate(object):
         self.slots = slots
         self.plimax = plimax
         self.outputpli = pos
+        self.fired = False
 
     def __repr__(self):
         rv = []
@@ -620,32 +1196,36 @@ class syncstate(object):
                                                      cBLUE, self.outputpli, cNORMAL, 
                                                      cDARK, id(self), cNORMAL)
 
-    @informobjp(updater = True)
+    @informobjp(updater = True, sub = 'sync')
     def storeRec(self, H, r):
         for h in H:
             assert h in self.slots
             assert self.slots[h] is None
             self.slots[h] = r
 
-    @informobj
+    @informobjp(sub = 'sync')
+    def isFilled(self, pat):
+        return self.slots[pat] is not None
+
+    @informobjp(sub = 'sync')
     def getPlimax(self, pat):
         assert pat in self.plimax
         return self.plimax[pat]
 
-    @informobjp(updater = True)
+    @informobjp(updater = True, sub = 'sync')
     def setPlimax(self, pat, val):
         assert pat in self.plimax
         self.plimax[pat] = val
 
-    @informobj
+    @informobjp(sub = 'sync')
     def getOutputpli(self):
         return self.outputpli
 
-    @informobjp(updater = True)
+    @informobjp(updater = True, sub = 'sync')
     def setOutputpli(self, val):
         self.outputpli = val
 
-    @informobj
+    @informobjp(sub = 'sync')
     def isComplete(self, H):
         # """The procedure isComplete is true if all slots, except
         # those indicated in its second argument, have been filled by
@@ -659,7 +1239,14 @@ class syncstate(object):
 
         return True
 
-    @informobj
+    @informobjp(sub = 'sync')
+    def isFinished(self):
+        # once the combined record has been produced, every pattern has
+        # been claimed (its plimax is INFINITY), so no further record can
+        # be stored in this state.
+        return self.fired
+
+    @informobjp(sub = 'sync')
     def matchesAll(self, H):
         # H is the set of all fields in the synchroncell for which the current record
         # is *the* candidate, ie all slots with a matching pattern that were not filled by predecessors.
@@ -670,7 +1257,7 @@ class syncstate(object):
                 return False
         return True
 
-    @informobj
+    @informobjp(sub = 'sync')
     def combineSyncMatches(self, H, rec):
         # """The procedure isComplete is true if all slots, except
         # those indicated in its second argument, have been filled by
@@ -679,97 +1266,235 @@ class syncstate(object):
         # with the combined result"""
         # -> combine only combines the slots not in H
 
+        # field references are shared with copyref(), then the
+        # records other than baserec are released with the fields
+        # they do not contribute.
+
         firstpat = self.pats[0]
         if self.slots[firstpat] is None:
             assert firstpat in H
             baserec = rec
         else:
             baserec = self.slots[firstpat]
-        log("baserec = %r", baserec)
+        trsync.debug("baserec = %r", baserec)
 
+        sources = {id(rec) : rec, id(baserec) : baserec}
         for k in self.pats[1:]:
             if k in H:
                 sourcerec = rec
             else:
                 sourcerec = self.slots[k]
+                sources[id(sourcerec)] = sourcerec
             
             for t in k:
-                baserec[t] = sourcerec[t]
-
+                v = sourcerec[t]
+                if type(v) is fieldref:
+                    v = fielddb.copyref(v)
+                old = baserec.get(t)
+                baserec[t] = v
+                if type(old) is fieldref:
+                    fielddb.release(old)
+
+        del sources[id(baserec)]
+        for r in sources.itervalues():
+            releaseRec(r)
+
+        self.fired = True
         return baserec
 
-all_syncstates = {}
+instanceids = itertools.count()
 
-@inform
-def getSyncState(pos, K):
-    if pos not in all_syncstates:
-        all_syncstates[pos] = syncstate(pos, K)
-    return all_syncstates[pos]
-   
-@handletc
-@inform 
-def handleSync(cont, c, K):
+# the replica being built by the current thread (tablecollector.build,
+# see newReplica): its name, and the sync tables created for it
+tablecollector = threading.local()
 
-    s = getSyncState(c.pos, K)
-    log("s = %r", s)
+class ReplicaBuild(object):
 
-    M = K(c.record)
-    log("M := %r", M)
-
-    H = set()
-    pli = c.pli
-
-    while len(M) > 0:
-        newM = set(M)
-        for p in M:
-            plimax = s.getPlimax(p)
-            if plimax > pli:
-                newM.remove(p)
-            elif pli > c.pos:
-                newM.remove(p)
-                H.add(p)
-                plimax = INFINITY
-            s.setPlimax(p, maxindex(pli, plimax))
-            if c.pli > pli:
-                c.propagatePli()
-                pli = c.pli
-        M = newM
-        log("M := %r", M)
-
-    log("H = %r" % H)
-
-    if len(H) > 0: # and not s.matchesAll(H):
-        done = False
-        while not done:
-            done = False
-            plimin = s.getOutputpli()
-
-            log("pli = %r, plimin = %r", pli, plimin)
-
-            if s.isComplete(H):
-                log("isComplete = yes")
-                r = s.combineSyncMatches(H, c.record)
-                c.setRec(r)
-                done = True
-
-            elif pli > plimin:
-                log("pli > plimin")
-                s.storeRec(H, c.record)
-                c.markAsDone()
-                done = True
+    def __init__(self, name):
+        self.name = name
+        self.ids = itertools.count()
+        self.tables = []
+
+def instanceName(kind):
+    # a name for a synchrocell or replicator, for its counters. Those
+    # built for a replica are numbered within it, so that the same
+    # synchrocell gets the same name in all the replicas of a network.
+    build = getattr(tablecollector, 'build', None)
+    if build is None:
+        return '%s#%d' % (kind, next(instanceids))
+    return '%s.%s#%d' % (build.name, kind, next(build.ids))
 
-            s.setOutputpli(minindex(pli, plimin))
+class SyncTable(object):
+    # the sync states of one synchrocell, keyed by position.
+    # The table is split in shards, each with its own dict and lock,
+    # so that records at different positions do not contend.
+    #
+    # This does not help the common case: all the records that reach a
+    # synchrocell of a Seq network are at the same position, so they
+    # use the same state and the same shard. No other key would do, as
+    # the records at one position must meet in one state. Synchrocells
+    # run in parallel with each other, as each has its own table; the
+    # records of one synchrocell are serialized on its shard lock.
+
+    def __init__(self, K, nshards = 8):
+        self.K = K
+        self.shards = [({}, threading.Lock()) for i in xrange(nshards)]
+        # matches, stores, completions, wait (see handleSync). The
+        # replicas of a synchrocell share the counters of the first
+        # one, so that they do not accumulate as replicas come and go.
+        self.counters = counters('%s %r' % (instanceName('sync'), K))
+        all_synctables.add(self)
+        build = getattr(tablecollector, 'build', None)
+        if build is not None:
+            build.tables.append(self)
 
-            log("c.pli = %r, pli = %r", c.pli, pli)
+    def __repr__(self):
+        return '<SyncTable %r: %d states>' % (self.K, len(self))
+
+    def __len__(self):
+        return sum((len(states) for states, lock in self.shards))
+
+    def shard(self, pos):
+        return self.shards[hash(pos) % len(self.shards)]
+
+    @informobjp(sub = 'sync')
+    def getSyncState(self, pos):
+        # the caller must hold the lock of shard(pos)
+        states, lock = self.shard(pos)
+        if pos not in states:
+            states[pos] = syncstate(pos, self.K)
+        return states[pos]
+
+    @informobjp(sub = 'sync')
+    def releaseSyncState(self, pos, s):
+        # drop a finished state, so that the table does not grow with
+        # the number of records that went through the synchrocell. The
+        # next record to reach this position starts with a fresh state.
+        # the caller must hold the lock of shard(pos)
+        states, lock = self.shard(pos)
+        if states.get(pos) is s:
+            del states[pos]
+
+all_synctables = weakref.WeakSet()
+
+def countSyncStates():
+    # number of live sync states, over all synchrocells
+    return sum((len(t) for t in list(all_synctables)))
 
-            if c.pli > pli:
-                c.propagatePli()
-                pli = c.pli
+@handletc
+@informp(sub = 'sync')
+def handleSync(cont, c, K, table):
 
-            log("-> pli = %r, c = %r", pli, c)
+    M = K(c.record)
+    trsync.debug("M := %r", M)
+
+    if len(M) > 0:
+        # only consult the sync state once all predecessors have
+        # moved past this position: states are released when they
+        # fire, so this ensures that successive records meet the
+        # state in stream order, as they do without threads.
+        # As a consequence the loops below always complete in one
+        # pass: every pattern in M is either overtaken or claimed,
+        # and pli > pos >= outputpli.
+        cnt = table.counters
+        if cnt.on:
+            cnt.count('matches')
+
+        with listlock:
+            if c.pli <= c.pos:
+                start = time.time()
+                while c.pli <= c.pos:
+                    c.waitUpdate()
+                if cnt.on:
+                    cnt.addTime('wait', time.time() - start)
+
+        pos = c.pos
+        stored = False
+
+        states, shardlock = table.shard(pos)
+        with shardlock:
+            s = table.getSyncState(pos)
+            trsync.debug("s = %r", s)
+
+            H = set()
+            pli = c.pli
+
+            while len(M) > 0:
+                newM = set(M)
+                for p in M:
+                    plimax = s.getPlimax(p)
+                    if plimax > pli or s.isFilled(p):
+                        # overtaken, or the slot is taken already:
+                        # the record passes through. A claimed slot has
+                        # plimax INFINITY, which does not overtake a
+                        # record at the head of the stream (pli is
+                        # INFINITY too): hence the test of the slot.
+                        newM.remove(p)
+                    elif pli > c.pos:
+                        newM.remove(p)
+                        H.add(p)
+                        plimax = INFINITY
+                    s.setPlimax(p, maxindex(pli, plimax))
+                    if c.pli > pli:
+                        with listlock:
+                            c.propagatePli()
+                        pli = c.pli
+                M = newM
+                trsync.debug("M := %r", M)
+
+            trsync.debug("H = %r", H)
+
+            if len(H) > 0: # and not s.matchesAll(H):
+                done = False
+                while not done:
+                    done = False
+                    plimin = s.getOutputpli()
+
+                    trsync.debug("pli = %r, plimin = %r", pli, plimin)
+
+                    if s.isComplete(H):
+                        trsync.debug("isComplete = yes")
+                        r = s.combineSyncMatches(H, c.record)
+                        c.setRec(r)
+                        if evlog.on:
+                            evlog.emit(EV_COMBINE, c)
+                        if cnt.on:
+                            cnt.count('completions')
+                        done = True
+
+                    elif pli > plimin:
+                        trsync.debug("pli > plimin")
+                        s.storeRec(H, c.record)
+                        if evlog.on:
+                            evlog.emit(EV_STORE, c)
+                        if cnt.on:
+                            cnt.count('stores')
+                        done = stored = True
+
+                    s.setOutputpli(minindex(pli, plimin))
+
+                    trsync.debug("c.pli = %r, pli = %r", c.pli, pli)
+
+                    if not stored and c.pli > pli:
+                        with listlock:
+                            c.propagatePli()
+                        pli = c.pli
+
+                    trsync.debug("-> pli = %r, c = %r", pli, c)
+
+                if s.isFinished():
+                    table.releaseSyncState(pos, s)
+
+            if stored:
+                # markAsDone last: from then on c may be recycled
+                with listlock:
+                    c.markAsDone()
+                return
 
     if not c.isDone():
         c.posInc()
+        with listlock:
+            c.propagatePos()
 
         return tailcall(cont, c)
 
@@ -780,6 +1505,9 @@ class SyncMatcher(object):
         assert len(patterns) > 0
         self.pats = patterns
 
+        # compiled form: the fieldMask() of each pattern
+        self.masks = tuple(((tv, fieldMask(tv)) for tv in patterns))
+
     def __repr__(self):
         return "[| %s |]" % ', '.join((repr(x) for x in self.pats))
 
@@ -791,19 +1519,32 @@ class SyncMatcher(object):
         #    contains at least one input variant tv that is equal to
         #    or a supertype (i.e. subset) of tr. This means that a
         #    network does not need all fields and tags in a record.
-        tr = rec.keys()
+        return self.matchSignature(recSignature(rec))
 
-        matches = set()
-        for tv in self.pats:
-            # tr matches pats if all names in tv are in tr
-            failmatch = False
-            for t in tv:
-                if t not in tr:
-                    failmatch = True
-                    break
-            if not failmatch:
-                matches.add(tv)
-        return matches
+    def matchSignature(self, tr):
+        # tr matches tv if all names in tv are in tr
+        return set((tv for tv, m in self.masks if tr & m == m))
+
+    def matchBatch(self, recs):
+        # classify a burst of records at once. Returns, like __call__,
+        # the set of matched patterns for each record.
+
+        sigs = [recSignature(r) for r in recs]
+        if numpy is None:
+            return [self.matchSignature(tr) for tr in sigs]
+
+        # the signatures and pattern masks are split in 64-bit words;
+        # the (records x patterns) match matrix is computed with one
+        # vector operation per word.
+        pats = [tv for tv, m in self.masks]
+        ok = numpy.ones((len(sigs), len(pats)), dtype = bool)
+        for w in xrange((len(fieldbits) + 63) // 64):
+            shift = 64 * w
+            S = numpy.array([(tr >> shift) & WORDMASK for tr in sigs], dtype = numpy.uint64)
+            P = numpy.array([(m >> shift) & WORDMASK for tv, m in self.masks], dtype = numpy.uint64)
+            ok &= (S[:, None] & P[None, :]) == P[None, :]
+
+        return [set((pats[j] for j in numpy.flatnonzero(row))) for row in ok]
 
 # test code
 if __name__ == "__main__" and sys.argv[1] == 'sync':
@@ -852,6 +1593,37 @@ if __name__ == "__main__" and sys.argv[1] == 'sync':
         net = Top_sync(
             Sync_sync(SyncMatcher((Pattern(('str',)),)))
             )
+    elif sys.argv[2] == "fields":
+        @inform
+        def share(outf, s):
+            # {str} -> {A}|{B}, both referencing the same data
+            l = s['str'].rstrip()
+            f = outf.new(len(l), BYTES_UNALIGNED)
+            rw, data = outf.access(f)
+            data[:len(l)] = l
+            outf(Rec({'A' : f}))
+            outf(Rec({'B' : f}))
+
+        net = Top_sync(
+            Seq_sync(
+                Box_sync(share),
+                Sync_sync(SyncMatcher((Pattern(('A',)), Pattern(('B',)))))
+                )
+            )
+    elif sys.argv[2] == "twice":
+        @inform
+        def dupA(outf, s):
+            # {str} -> {A}|{A}|{B}: the second {A} passes through
+            outf(Rec({'A' : s['str'] + '1'}))
+            outf(Rec({'A' : s['str'] + '2'}))
+            outf(Rec({'B' : s['str'] + '3'}))
+
+        net = Top_sync(
+            Seq_sync(
+                Box_sync(dupA),
+                Sync_sync(SyncMatcher((Pattern(('A',)), Pattern(('B',)))))
+                )
+            )
     else:
         net = Top_sync(
             Seq_sync(
@@ -862,58 +1634,920 @@ if __name__ == "__main__" and sys.argv[1] == 'sync':
 
     net()
 
+    # every field was released by the output, every sync state
+    # once it fired
+    assert len(fielddb) == 0
+    assert countSyncStates() == 0
 
-# -------- C_{hydra} -------
 
+# -------- coroutine backend for C_{mult} and C_{sync} -------
 
-def Box_hydra(f):
-    return lambda cont,c : handleMult(cont, c, f(c.record)) # tailcall
+# All the continuations run as coroutines (see coro.py) on a single
+# thread. A box function can be a generator: it can then yield a
+# future, for example sleep(t), readable(fd) or runInThread(f, args),
+# to let the other records progress while it waits for I/O.
+# Plain box functions work unchanged.
 
-def Sync_hydra(K):
-    return lambda cont, c: handleSync(cont, c, K) # tailcall
+def Box_async(f):
 
+    f = countBox(cleanupBox(f))
+    syncmode = mode == MODE_SYNC
+    boxid = boxId(f.__name__)
 
+    @informp(f)
+    def boxf(cont, c):
 
-def Seq_hydra(N, M):
-    def rf(cont, c):
-        cont_M = lambda cp: cont(posQes(cp))
-        cont_N = lambda x: cont_M( M((lambda cp: posInc(cp)), x) )
-        return N(cont_N, posSeq(c))
-    return rf
+        if syncmode:
+            c.posInc()
 
-        
-def Par_hydra(sigma, N, M):
-    def rf(cont, c):
-        contp = lambda cp: contp(posTla(cp))
-        left = lambda cp: N(contp, posAlt(cp, 0))
-        right = lambda cp: M(contp, posAlt(cp, 1))
-        if sigma(c.record) == 0:
-            return left(c) # tailcall
-        else:
-            return right(c) # tailcall
-    return rf
-
-def Star_hydra(gamma, N):
-    def rf(cont, c):
-        def rec(cp):
-            if gamma(cp) == True: # gamma must return True to indicate star expansion
-                rec(posRepl(cp)) # tailcall
-            else:
-                cont(posReti(cp)) # tailcall
-        return rec(posIter(c))
-    return rf
+        d = [c, None]
 
-def Bling_hydra(N, tag):
-    def rf(cont, c):
-        contp = lambda cp: cont(posTla(cp))
-        cp = posAlt(c, c.record[t])
-        return N(contp, cp)
-    return rf
+        @inform
+        def outf(r):
+            c, prevrec = d
+            if prevrec is not None:
+                c = insertContainerAsync(cont, c, prevrec[0])
+            d[0:2] = (c, (r,))
 
-def Top_hydra(N):
+        if evlog.on:
+            evlog.emit(EV_BOXIN, c, boxid)
+        res = f(outf, c.record)
+        if isinstance(res, types.GeneratorType):
+            yield res
+        if evlog.on:
+            evlog.emit(EV_BOXOUT, d[0], boxid)
+
+        c, lastrec = d
+        if lastrec is None:
+            with listlock:
+                c.markAsDone()
+        else:
+            c.setRec(lastrec[0])
+
+            yield cont(c)
+
+    return boxf
+
+def Seq_async(N, M):
+
+    @informp(N, M)
+    def seqf(cont, c):
+
+        @inform
+        def seqf_cont_N(cp):
+            return M(cont, cp)
+
+        return N(seqf_cont_N, c)
+
+    return seqf
+
+def Sync_async(K):
+
+    table = SyncTable(K)
+
+    @informp(K, sub = 'sync')
+    def syncf(cont, c):
+        # the wait in handleSync() would block the loop: do
+        # it here, then handleSync() never has to wait.
+        if len(K(c.record)) > 0:
+            while True:
+                with listlock:
+                    if c.pli > c.pos:
+                        break
+                    f = c.waiter = Future()
+                yield f
+                c.waiter = None
+
+        res = handleSync(cont, c, K, table)
+        if res is not None:
+            yield res
+
+    return syncf
+
+def Top_async(N):
+
+    selectContainer()
+
+    @informp(N)
+    def topf():
+
+        @inform
+        def topf_cont_in(c):
+            return N(handleOutputAsync, c)
+
+        runLoop(handleInputAsync(topf_cont_in))
+
+        flushOutput()
+
+    return topf
+
+@inform
+def insertContainerAsync(cont, c, r):
+    cp = linkContainer(c, r)
+
+    spawn(cont(c))
+
+    return cp
+
+@informp(sub = 'io')
+def handleInputAsync(cont):
+
+    t = newContainer()
+
+    with listlock:
+        t.markAsFirst()
+
+    fd = sys.stdin.fileno()
+    sp = RecordSplitter()
+    n = 0
+
+    while True:
+        yield readable(fd)
+        chunk = os.read(fd, sp.chunksize)
+        if chunk == '':
+            break
+        for line in sp.feed(chunk):
+            n += 1
+            t = inputRecord(insertContainerAsync, cont, t, line, n)
+
+    for line in sp.finish():
+        n += 1
+        t = inputRecord(insertContainerAsync, cont, t, line, n)
+
+    trio.debug("read input: EOF")
+
+@informp(sub = 'io')
+def handleOutputAsync(c):
+    # like handleOutput(), but waits for a future
+    # set by markAsFirst() instead of a condition.
+    start = None
+    while True:
+        with listlock:
+            if c.isFirst():
+                break
+            f = c.waiter = Future()
+        if start is None:
+            start = time.time()
+        yield f
+        c.waiter = None
+    if outcounters.on:
+        if start is not None:
+            outcounters.addTime('wait', time.time() - start)
+        outcounters.count('records')
+
+    log("c = %r",  c)
+
+    if evlog.on:
+        evlog.emit(EV_OUTPUT, c)
+
+    writeOutput(c.record)
+
+    with listlock:
+        c.propagateFirst()
+        c.freeContainer()
+
+# test code
+if __name__ == "__main__" and sys.argv[1] == 'async':
+    print "testing async"
+
+    import random
+    import time
+
+    @inform
+    def stripnl(outf, s):
+        # {str} -> {str}
+        outf(Rec({'str' : s['str'].rstrip()}))
+
+    @inform
+    def slowdup(outf, s):
+        # {str} -> {A}|{B}, waiting for "I/O" before each output
+        yield sleep(random.random() * .01)
+        outf(Rec({'A' : s['str'] + '1'}))
+        yield sleep(random.random() * .01)
+        outf(Rec({'B' : s['str'] + '2'}))
+
+    @inform
+    def wrapcolon(outf, s):
+        # {A}|{B} -> {str}
+        outf(Rec({'str' : ':%s:' % s.values()[0]}))
+
+    @inform
+    def concat(outf, s):
+        # {A,B} -> {str}
+        outf(Rec({'str' : '<%s:%s>' % (s.get('A','?'), s.get('B','?'))}))
+
+    if sys.argv[2] == 'sync':
+        print "network = box(stripnl)..box(slowdup)..[|{A},{B}|]..box(concat)"
+        net = Top_async(
+            Seq_async(
+                Seq_async(Box_async(stripnl), Box_async(slowdup)),
+                Seq_async(
+                    Sync_async(SyncMatcher((Pattern(('A',)), Pattern(('B',))))),
+                    Box_async(concat))))
+    else:
+        print "network = box(stripnl)..box(slowdup)..box(wrapcolon)"
+        net = Top_async(
+            Seq_async(Box_async(stripnl),
+                      Seq_async(Box_async(slowdup), Box_async(wrapcolon))))
+
+    t = time.time()
+    net()
+    print >>sys.stderr, "%.3fs" % (time.time() - t)
+
+    # every sync state was released once it fired
+    assert countSyncStates() == 0
+
+
+# -------- C_{hydra} -------
+
+
+# Box functions take a record and return an iterable of records.
+# They have no cleanup list: the references of the input record that
+# are not forwarded in the outputs must be released by the box.
+#
+# Every network has a depth: the number of positions a record moves
+# through from its entry to its exit (one per box and synchrocell).
+# Par_hydra uses it to bring the records of both branches to the same
+# position on exit.
+
+def Box_hydra(f):
+
+    @handletc
+    @informp(f)
+    def boxf(cont, c):
+        c.posInc()
+        return tailcall(handleMult, cont, c, f(c.record))
+
+    boxf.depth = 1
+    return boxf
+
+def Sync_hydra(K):
+
+    table = SyncTable(K)
+
+    @handletc
+    @informp(K, sub = 'sync')
+    def syncf(cont, c):
+        return tailcall(handleSync, cont, c, K, table)
+
+    # handleSync() moves the record to the next position
+    syncf.depth = 1
+    return syncf
+
+def Seq_hydra(N, M):
+
+    @handletc
+    @informp(N, M)
+    def seqf(cont, c):
+
+        @handletc
+        @inform
+        def seqf_cont_N(cp):
+            return tailcall(M, cont, cp)
+
+        return tailcall(N, seqf_cont_N, c)
+
+    seqf.depth = N.depth + M.depth
+    return seqf
+
+@informobj
+def posTla(c, pad):
+    # leaving a branch that is pad positions shorter than the longest
+    # one: skip the positions the record did not go through.
+    c.pos = c.pos + pad
+
+def Par_hydra(sigma, N, M):
+    # sigma(record) chooses the branch: 0 for N, 1 for M. Each record
+    # is handed over to an idle worker thread if there is one, so that
+    # the records in both branches progress concurrently.
+
+    depth = max(N.depth, M.depth)
+    branches = ((N, depth - N.depth), (M, depth - M.depth))
+
+    @handletc
+    @informp(sigma, N, M)
+    def parf(cont, c):
+
+        # the position is kept when entering a branch, so that the
+        # records in either branch are ordered by how far they are
+        # in the network
+        B, pad = branches[sigma(c.record)]
+
+        if pad == 0:
+            contp = cont
+        else:
+            @handletc
+            @inform
+            def contp(cp):
+                posTla(cp, pad)
+                return tailcall(cont, cp)
+
+        if trySpawn(B, contp, c):
+            return
+        return tailcall(B, contp, c)
+
+    parf.depth = depth
+    return parf
+
+class Replica(object):
+    # one instance of the operand network of a Star or Bling
+    #
+    # inflight: the records in the network, besides those waiting in
+    # its synchrocells. It counts the containers that entered the
+    # replica (enterReplica) and did not leave it (leaveReplica), plus
+    # the containers inserted after them by boxes, minus those
+    # consumed (markAsDone). Protected by listlock.
+
+    def __init__(self, net, tables):
+        self.net = net
+        # the synchrocells of the replica
+        self.tables = tables
+        self.lastused = time.time()
+        self.inflight = 0
+
+    def __repr__(self):
+        return '<Replica %r, %d in flight, %d sync states>' % (self.net, self.inflight, self.pending())
+
+    def pending(self):
+        # records waiting in the synchrocells of the replica
+        return sum((len(t) for t in self.tables))
+
+    def unused(self, now, idle):
+        # whether the replica can be dropped: it holds no records, and
+        # none entered it for idle seconds
+        return self.inflight == 0 and now - self.lastused > idle and self.pending() == 0
+
+@informobj
+def enterReplica(c, r):
+    # the record of c goes into the network of r
+    with listlock:
+        r.inflight += 1
+        c.owner = (r, c.owner)
+
+@informobj
+def leaveReplica(c):
+    # the record of c comes out of its innermost replica, -> the replica
+    with listlock:
+        r, c.owner = c.owner
+        r.inflight -= 1
+    return r
+
+def newReplica(N, name):
+    # N() builds the network; name: that of the replicator
+    outer = getattr(tablecollector, 'build', None)
+    tablecollector.build = build = ReplicaBuild(name)
+    try:
+        net = N()
+        return Replica(net, build.tables)
+    finally:
+        tablecollector.build = outer
+
+STAR_MAXDEPTH = 32
+STAR_IDLE = 1.
+
+def Star_hydra(gamma, N, maxdepth = STAR_MAXDEPTH, idle = STAR_IDLE):
+    # Serial replication: while gamma(record) is true, the record goes
+    # through another replica of the operand network; otherwise it
+    # leaves the star. N() creates a replica.
+    #
+    # Replica k is created when a record first needs its k-th
+    # iteration. Replicas that hold no records and were not entered
+    # for idle seconds are dropped, and created again when needed; this
+    # is checked when a replica is created, and when one empties (at
+    # most once every idle seconds). A record needing more than
+    # maxdepth iterations is an error.
+    #
+    # Iteration k starts at position entry + k * depth(N). On exit the
+    # record moves to entry + maxdepth * depth(N), the depth of the
+    # star, so that records leave at the same position however many
+    # iterations they made. When it moves on, a record raises the pli
+    # of its successors (propagatePos), so that records that leave
+    # early are not held back by those that iterate further in the
+    # synchrocells of N, only by the output order.
+
+    replicas = {}
+    lock = threading.Lock()
+    name = instanceName('star')
+
+    # the time of the last reclaim()
+    reclaimed = [time.time()]
+
+    def reclaim(now):
+        # with lock held
+        reclaimed[0] = now
+        for k, r in replicas.items():
+            if r.unused(now, idle):
+                log("star: drop replica %d", k)
+                del replicas[k]
+
+    @inform
+    def replica(k, c):
+        # the network of replica k, which c enters
+        with lock:
+            r = replicas.get(k)
+            if r is None:
+                r = replicas[k] = newReplica(N, name)
+                reclaim(r.lastused)
+            else:
+                r.lastused = time.time()
+            enterReplica(c, r)
+            return r.net
+
+    @inform
+    def exited(r):
+        # a record left r
+        if r.inflight == 0:
+            now = time.time()
+            if now - reclaimed[0] > idle:
+                with lock:
+                    reclaim(now)
+
+    # replica 0 gives the depth of the operand network
+    replicas[0] = newReplica(N, name)
+    depthN = replicas[0].net.depth
+    depth = maxdepth * depthN
+    assert depth < INFINITY
+
+    @handletc
+    @inform
+    def iterate(cont, c, k, entry):
+        if not gamma(c.record):
+            # leave the star
+            c.pos = entry + depth
+            with listlock:
+                c.propagatePos()
+            return tailcall(cont, c)
+
+        if k == maxdepth:
+            raise RuntimeError('star: more than %d iterations for %r' % (maxdepth, c.record))
+
+        @handletc
+        @inform
+        def starf_cont_N(cp):
+            exited(leaveReplica(cp))
+            return tailcall(iterate, cont, cp, k + 1, entry)
+
+        return tailcall(replica(k, c), starf_cont_N, c)
+
+    @handletc
+    @informp(gamma, N)
+    def starf(cont, c):
+        return tailcall(iterate, cont, c, 0, c.pos)
+
+    starf.depth = depth
+    starf.replicas = replicas
+    return starf
+
+BLING_MAXREPLICAS = 1024
+
+def Bling_hydra(N, tag, maxreplicas = BLING_MAXREPLICAS, idle = STAR_IDLE):
+    # Indexed parallel replication: each record goes to the replica of
+    # the operand network for the value of its field tag. N() creates
+    # a replica. As in Par, records are handed over to an idle worker
+    # thread if there is one.
+    #
+    # Replicas are created on first use and kept in a cache of at
+    # most maxreplicas entries, in LRU order. Past that size the least
+    # recently used replicas are dropped if, as in Star, they were not
+    # entered for idle seconds and hold no records (Replica.unused);
+    # the cache only grows beyond its size when there are none.
+    #
+    # All replicas have the same depth, so records need no change of
+    # position on exit.
+
+    replicas = collections.OrderedDict()
+    lock = threading.Lock()
+    name = instanceName('bling')
+
+    # the first replica gives the depth of the operand network,
+    # it is used for the first tag value
+    spare = [newReplica(N, name)]
+
+    def evict(now):
+        # make room for one more replica
+        excess = len(replicas) + 1 - maxreplicas
+        if excess <= 0:
+            return
+        for key, r in replicas.items():
+            if r.unused(now, idle):
+                log("bling: drop replica %r", key)
+                del replicas[key]
+                excess -= 1
+                if excess == 0:
+                    break
+
+    @inform
+    def replica(key, c):
+        # the network of the replica for key, which c enters
+        with lock:
+            now = time.time()
+            r = replicas.pop(key, None)
+            if r is None:
+                evict(now)
+                if len(spare) > 0:
+                    r = spare.pop()
+                else:
+                    r = newReplica(N, name)
+            r.lastused = now
+            # most recently used last
+            replicas[key] = r
+            enterReplica(c, r)
+            return r.net
+
+    @handletc
+    @informp(N, tag)
+    def blingf(cont, c):
+        R = replica(c.record[tag], c)
+
+        @handletc
+        @inform
+        def blingf_cont_N(cp):
+            leaveReplica(cp)
+            return tailcall(cont, cp)
+
+        if trySpawn(R, blingf_cont_N, c):
+            return
+        return tailcall(R, blingf_cont_N, c)
+
+    blingf.depth = spare[0].net.depth
+    blingf.replicas = replicas
+    return blingf
+
+def Top_hydra(N):
+    selectContainer()
     return lambda: handleInput(lambda c: N((lambda cp: handleOutput(cp)), c))
 
+# test code
+if __name__ == "__main__" and sys.argv[1] == 'hydra':
+    print "testing hydra"
 
-        
-                            
-        
+    @inform
+    def dup(s):
+        # {str} -> {A}|{B}
+        l = s['str'].rstrip()
+        return [Rec({'A' : l + '1'}), Rec({'B' : l + '2'})]
+
+    @inform
+    def upper(s):
+        # {A} -> {A}
+        return [Rec({'A' : s['A'].upper()})]
+
+    @inform
+    def reverse(s):
+        # {B} -> {B}
+        return [Rec({'B' : s['B'][::-1]})]
+
+    @inform
+    def paren(s):
+        # {B} -> {B}
+        return [Rec({'B' : '(' + s['B'] + ')'})]
+
+    @inform
+    def concat(s):
+        # {A,B} -> {str}
+        return [Rec({'str' : '<%s:%s>' % (s.get('A','?'), s.get('B','?'))})]
+
+    if sys.argv[2] == 'par':
+        print "network = box(dup)..(box(upper)|box(reverse)..box(paren))..[|{A},{B}|]..box(concat)"
+        net = Top_hydra(
+            Seq_hydra(
+                Box_hydra(dup),
+                Seq_hydra(
+                    Par_hydra(lambda r: int('B' in r),
+                              Box_hydra(upper),
+                              Seq_hydra(Box_hydra(reverse), Box_hydra(paren))),
+                    Seq_hydra(
+                        Sync_hydra(SyncMatcher((Pattern(('A',)), Pattern(('B',))))),
+                        Box_hydra(concat)))))
+
+    elif sys.argv[2] == 'star':
+        @inform
+        def init(s):
+            # {str} -> {n,s}
+            l = s['str'].rstrip()
+            return [Rec({'n' : len(l) % 4, 's' : l})]
+
+        @inform
+        def fork(s):
+            # {n,s} -> {n,s,a}|{b}
+            return [Rec({'n' : s['n'], 's' : s['s'], 'a' : '+'}), Rec({'b' : '-'})]
+
+        @inform
+        def join(s):
+            # {n,s,a,b} -> {n,s}
+            return [Rec({'n' : s['n'] - 1, 's' : s['s'] + s['a'] + s['b']})]
+
+        @inform
+        def show(s):
+            # {n,s} -> {str}
+            return [Rec({'str' : s['s']})]
+
+        print "network = box(init)..(box(fork)..[|{n,a},{b}|]..box(join))*{n > 0}..box(show)"
+        net = Top_hydra(
+            Seq_hydra(
+                Box_hydra(init),
+                Seq_hydra(
+                    Star_hydra(lambda r: r['n'] > 0,
+                               lambda: Seq_hydra(
+                                   Box_hydra(fork),
+                                   Seq_hydra(
+                                       Sync_hydra(SyncMatcher((Pattern(('n', 'a')), Pattern(('b',))))),
+                                       Box_hydra(join)))),
+                    Box_hydra(show))))
+
+    elif sys.argv[2] == 'early':
+        # records leave the star after n iterations of a slow box; with
+        # enough worker threads they leave in the order of n, not in
+        # stream order
+        exits = []
+
+        @inform
+        def init(s):
+            # {str} -> {n,i}
+            n = int(s['str'])
+            return [Rec({'n' : n, 'i' : n})]
+
+        @inform
+        def fork(s):
+            # {n,i} -> {n,i,a}|{b}
+            time.sleep(.05)
+            return [Rec({'n' : s['n'], 'i' : s['i'], 'a' : 1}), Rec({'b' : 1})]
+
+        @inform
+        def join(s):
+            # {n,i,a,b} -> {n,i}
+            return [Rec({'n' : s['n'] - 1, 'i' : s['i']})]
+
+        @inform
+        def show(s):
+            # {n,i} -> {str}
+            exits.append(s['i'])
+            return [Rec({'str' : '%d' % s['i']})]
+
+        print "network = box(init)..(box(fork)..[|{n,a},{b}|]..box(join))*{n > 0}..box(show)"
+        net = Top_hydra(
+            Seq_hydra(
+                Box_hydra(init),
+                Seq_hydra(
+                    Star_hydra(lambda r: r['n'] > 0,
+                               lambda: Seq_hydra(
+                                   Box_hydra(fork),
+                                   Seq_hydra(
+                                       Sync_hydra(SyncMatcher((Pattern(('n', 'a')), Pattern(('b',))))),
+                                       Box_hydra(join)))),
+                    Box_hydra(show))))
+
+    elif sys.argv[2] == 'bling':
+        @inform
+        def init(s):
+            # {str} -> {k,v}
+            v = int(s['str'])
+            return [Rec({'k' : v % 3, 'v' : v})]
+
+        @inform
+        def ab(s):
+            # {k,v} -> {a}|{b}
+            if (s['v'] // 3) % 2 == 0:
+                return [Rec({'a' : s['v']})]
+            return [Rec({'b' : s['v']})]
+
+        @inform
+        def show(s):
+            # {a,b} -> {str}
+            return [Rec({'str' : '%d+%d' % (s['a'], s['b'])})]
+
+        # each replica pairs the records of one value of k
+        print "network = box(init)..(box(ab)..[|{a},{b}|])!k..box(show)"
+        net = Top_hydra(
+            Seq_hydra(
+                Box_hydra(init),
+                Seq_hydra(
+                    Bling_hydra(lambda: Seq_hydra(
+                                    Box_hydra(ab),
+                                    Sync_hydra(SyncMatcher((Pattern(('a',)), Pattern(('b',)))))),
+                                'k', maxreplicas = 2),
+                    Box_hydra(show))))
+
+    net()
+
+    # every sync state was released once it fired
+    assert countSyncStates() == 0
+
+    if sys.argv[2] == 'early':
+        print >>sys.stderr, "exit order:", exits
+        # records waiting for their turn at the output hold a thread:
+        # with fewer threads than records, some may only start late
+        if int(os.getenv('HYDRA_THREADS', '0')) > len(exits):
+            assert exits == sorted(exits)
+
+
+
+# -------- benchmarks -------
+
+if __name__ == "__main__" and sys.argv[1] == 'bench' and sys.argv[2] == 'mult':
+    # handleMult must cost O(N) for a box invocation producing N records:
+    # the cost per record must not grow with N. The garbage collector
+    # is disabled while timing, as its passes over the N containers
+    # still linked add a cost that grows with N. The bound below leaves
+    # room for noise; a quadratic cost would exceed it tenfold.
+    import time
+    import gc
+
+    print "benchmarking handleMult: N outputs per box invocation"
+
+    selectContainer()
+
+    def drop(c):
+        pass
+
+    perrec = {}
+    for n in (1000, 10000, 100000, 1000000):
+        recs = [Rec({'str': 'x'})] * n
+
+        # best of 3, without the pauses of the garbage collector
+        best = None
+        for i in xrange(3):
+            t = newContainer()
+            t.markAsFirst()
+
+            gc.disable()
+            start = time.time()
+            handleMult(drop, t, recs)
+            dt = time.time() - start
+            gc.enable()
+
+            best = dt if best is None else min(best, dt)
+            del t
+            gc.collect()
+
+        perrec[n] = best * 1e6 / n
+        print "N = %8d  total %8.3fs  per record %6.3fus" % (n, best, perrec[n])
+
+    assert max(perrec.values()) < 4 * min(perrec.values()), "handleMult is not linear"
+
+if __name__ == "__main__" and sys.argv[1] == 'bench' and sys.argv[2] == 'match':
+    # SyncMatcher with 50 patterns over records with 60 fields
+    import time
+    import random
+
+    print "benchmarking SyncMatcher: 50 patterns, 60 fields per record"
+
+    def naivematch(pats, rec):
+        # the matching algorithm before patterns were compiled
+        tr = rec.keys()
+        matches = set()
+        for tv in pats:
+            failmatch = False
+            for t in tv:
+                if t not in tr:
+                    failmatch = True
+                    break
+            if not failmatch:
+                matches.add(tv)
+        return matches
+
+    random.seed(42)
+    names = ['f%d' % i for i in xrange(100)]
+    pats = tuple((Pattern(random.sample(names, random.randint(1, 4))) for i in xrange(50)))
+    K = SyncMatcher(pats)
+    recs = [Rec(((n, i) for n in random.sample(names, 60))) for i in xrange(10000)]
+
+    for r in recs:
+        assert K(r) == naivematch(pats, r)
+    assert K.matchBatch(recs) == [K(r) for r in recs]
+
+    start = time.time()
+    for r in recs:
+        naivematch(pats, r)
+    dtnaive = time.time() - start
+
+    start = time.time()
+    for r in recs:
+        K(r)
+    dt = time.time() - start
+
+    start = time.time()
+    K.matchBatch(recs)
+    dtbatch = time.time() - start
+
+    print "naive    %6.2fus per record" % (dtnaive * 1e6 / len(recs))
+    print "compiled %6.2fus per record" % (dt * 1e6 / len(recs))
+    print "batch    %6.2fus per record%s" % (dtbatch * 1e6 / len(recs),
+                                             ['', ' (numpy not available)'][numpy is None])
+
+if __name__ == "__main__" and sys.argv[1] == 'bench' and sys.argv[2] == 'tc':
+    # cost of one hop between continuations, on Seq chains of
+    # increasing depth; compared with the fn package if available
+    import time
+
+    print "benchmarking tail calls: Seq_mult chains of box(ident)"
+
+    engines = [('tc', tailcall, handletc)]
+    try:
+        import fn
+        engines.append(('fn', fn.tailcall, fn.handletc))
+    except ImportError:
+        print "(fn not available, measuring the built-in engine only)"
+
+    selectContainer()
+
+    def ident(outf, s):
+        outf(s)
+
+    def drop(c):
+        pass
+
+    t = newContainer()
+    t.markAsFirst()
+    t.setRec(Rec({'str': 'x'}))
+
+    for depth in (1, 10, 100, 1000, 10000):
+        n = max(10, 100000 // depth)
+        for name, tailcall, handletc in engines:
+            # the loop variables rebind the module globals, so the
+            # network below is built with this engine
+            net = Box_mult(ident)
+            for i in xrange(depth - 1):
+                net = Seq_mult(Box_mult(ident), net)
+
+            start = time.time()
+            for i in xrange(n):
+                net(drop, t)
+            dt = time.time() - start
+
+            print "%-3s depth %5d  per box %6.3fus" % (name, depth, dt * 1e6 / (n * depth))
+
+    tailcall, handletc = engines[0][1:]
+
+if __name__ == "__main__" and sys.argv[1] == 'bench' and sys.argv[2] == 'fuse':
+    # the 5 one-to-one boxes of "mult 1i", with and without compileNet()
+    import time
+
+    print "benchmarking compileNet: network of mult 1i"
+
+    selectContainer()
+
+    @onetoone
+    def ident(outf, s):
+        outf(s)
+
+    def drop(c):
+        pass
+
+    net = Seq_mult(Box_mult(ident), Seq_mult(Seq_mult(Box_mult(ident), Box_mult(ident)),
+                                             Seq_mult(Box_mult(ident), Box_mult(ident))))
+
+    t = newContainer()
+    t.markAsFirst()
+    t.setRec(Rec({'str': 'x'}))
+
+    n = 100000
+    for name, N in (('1 box', Box_mult(ident)), ('5 boxes', net), ('5 boxes fused', compileNet(net))):
+        start = time.time()
+        for i in xrange(n):
+            N(drop, t)
+        dt = time.time() - start
+
+        print "%-14s per record %6.3fus" % (name, dt * 1e6 / n)
+
+if __name__ == "__main__" and sys.argv[1] == 'bench' and sys.argv[2] == 'fields':
+    # a 16MB payload through a chain of boxes that each keep its
+    # second half: string slices copy it, field slices do not
+    import time
+
+    print "benchmarking fields: 16MB payload through 10 x box(half)"
+
+    selectContainer()
+
+    def halfstr(outf, s):
+        l = s['str']
+        outf(Rec({'str' : l[len(l) // 2:]}))
+
+    def halffield(outf, s):
+        rw, data = outf.access(s['bytes'])
+        n = len(data) // 2
+        outf(Rec({'bytes' : outf.wrap(BYTES_UNALIGNED, len(data) - n, data[n:])}))
+
+    def drop(c):
+        releaseRec(c.record)
+
+    payload = 'x' * (1 << 24)
+    t = newContainer()
+    t.markAsFirst()
+
+    n = 100
+    for name, f, mkrec in (('str', halfstr, lambda: Rec({'str' : payload})),
+                           ('field', halffield, lambda: Rec({'bytes' : fielddb.wrap(BYTES_UNALIGNED, len(payload), payload)}))):
+        net = Box_mult(f)
+        for i in xrange(9):
+            net = Seq_mult(Box_mult(f), net)
+
+        start = time.time()
+        for i in xrange(n):
+            t.setRec(mkrec())
+            net(drop, t)
+        dt = time.time() - start
+
+        print "%-6s per record %8.3fus" % (name, dt * 1e6 / n)
+
+    assert len(fielddb) == 0
@@ -1,39 +1,184 @@
 import sys
 import os
+import threading
 
 from colors import *
 
-debug = os.getenv('VERBOSE')
+# Tracing, by subsystem ("core", "io", "obj", "sync", ...) and level.
+#
+# VERBOSE enables all the messages. HYDRA_TRACE enables some
+# subsystems, eg. "sync,io=info" ("sub" alone means "sub=debug",
+# "*" applies to all subsystems). HYDRA_TRACE_SAMPLE=N traces only one
+# in N input records: the calls on the containers of the other records
+# are not shown, nor the messages logged during these calls (warnings
+# and errors excepted). setTrace() and setSampling() change these at
+# run time.
+#
+# Messages are formatted only when they are enabled; call sites on hot
+# paths can test "if tracer.on:" (true when debug messages are
+# enabled) to skip the call altogether. The @inform* decorators only
+# wrap a function if its subsystem is enabled at the time it is
+# decorated, that is when the network is built: otherwise they return
+# the function unchanged.
+
+# levels, as in langif.h
+LOG_NOTSET = 0
+LOG_DEBUG = 10   # printf-style debugging
+LOG_INFO = 20    # what is being communicated, identifiers, etc.
+LOG_WARN = 30    # unexpected conditions, can resume
+LOG_ERROR = 40   # unexpected condition, will terminate computation prematurely
+LOG_FATAL = 50   # unexpected condition, behavior undefined
+LOG_OFF = 100
+
+levelnames = {
+    'notset' : LOG_NOTSET,
+    'debug' : LOG_DEBUG,
+    'info' : LOG_INFO,
+    'warn' : LOG_WARN,
+    'error' : LOG_ERROR,
+    'fatal' : LOG_FATAL,
+    'off' : LOG_OFF,
+}
+
+def parseLevel(s):
+    if s.isdigit():
+        return int(s)
+    return levelnames[s.lower()]
+
+class Tracer(object):
+    __slots__ = ('name', 'level', 'on')
+
+    def __init__(self, name, level):
+        self.name = name
+        self.setLevel(level)
+
+    def __repr__(self):
+        return '<Tracer %s level %d>' % (self.name, self.level)
+
+    def setLevel(self, level):
+        self.level = level
+        self.on = level <= LOG_DEBUG
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, fmt, *args, **kwargs):
+        # warnings and errors are not sampled
+        if level >= self.level and (level >= LOG_WARN or current.traced):
+            emit(fmt, args, kwargs.get('more', False))
+
+    def debug(self, fmt, *args, **kwargs):
+        if self.on and current.traced:
+            emit(fmt, args, kwargs.get('more', False))
+
+    def info(self, fmt, *args):
+        self.log(LOG_INFO, fmt, *args)
+
+    def warn(self, fmt, *args):
+        self.log(LOG_WARN, fmt, *args)
+
+# initial levels: default for all subsystems, then per subsystem
+tracelevels = {'*' : [LOG_OFF, LOG_DEBUG][bool(os.getenv('VERBOSE'))]}
+for item in os.getenv('HYDRA_TRACE', '').split(','):
+    if item != '':
+        name, _, lvl = item.partition('=')
+        tracelevels[name.strip()] = parseLevel(lvl.strip() or 'debug')
+
+tracers = {}
+
+def tracer(name):
+    t = tracers.get(name)
+    if t is None:
+        t = tracers[name] = Tracer(name, tracelevels.get(name, tracelevels['*']))
+    return t
+
+def setTrace(name, level):
+    # set the level of a subsystem, or of all of them with '*'
+    tracelevels[name] = level
+    if name == '*':
+        for t in tracers.values():
+            t.setLevel(level)
+    else:
+        tracer(name).setLevel(level)
+
+# --------- sampling -------
+
+sampling = {'every' : int(os.getenv('HYDRA_TRACE_SAMPLE', '1')), 'count' : 0}
+
+def setSampling(every):
+    assert every > 0
+    sampling['every'] = every
+    sampling['count'] = 0
+
+def sampleNext():
+    # whether the next input record is traced. Not locked: under
+    # threads the period is only approximate.
+    n = sampling['every']
+    if n == 1:
+        return True
+    sampling['count'] = c = (sampling['count'] + 1) % n
+    return c == 0
+
+class TraceState(threading.local):
+    # traced: whether the messages of the current thread are shown,
+    # as decided by the innermost traced call (see sampled)
+    traced = True
+
+current = TraceState()
+
+def sampled(args):
+    # whether a call is traced: false when the arguments include
+    # containers, none of which carry a traced record; like the
+    # calling function when there are no containers.
+    seen = False
+    for a in args:
+        t = getattr(a, 'traced', None)
+        if t:
+            return True
+        seen = seen or t is not None
+    return not seen and current.traced
+
+# --------- output -------
+
 ilevel = 0
 continued = False
-def log(fmt, *args, **kwargs):
-    global ilevel, continued
-    if debug:
-        if not continued:
-            sys.stderr.write('%s%s' % ('--', '|  ' * ilevel))
 
-        sys.stderr.write(fmt % args)
+def emit(fmt, args, more):
+    global continued
+    if not continued:
+        sys.stderr.write('%s%s' % ('--', '|  ' * ilevel))
 
-        if kwargs.get('more', False):
-            continued = True
-        else:
-            sys.stderr.write('\n')
-            continued = False
+    if len(args) > 0:
+        fmt = fmt % args
+    sys.stderr.write(fmt)
+
+    if more:
+        continued = True
+    else:
+        sys.stderr.write('\n')
+        continued = False
+
+core = tracer('core')
+
+def log(fmt, *args, **kwargs):
+    # debug message of the core subsystem
+    if core.on and current.traced:
+        emit(fmt, args, kwargs.get('more', False))
 
 def enter(fmt = None, *args):
     global ilevel
     if fmt is not None:
-        log(fmt, *args, more = True)
-        log(':')
+        emit(fmt, args, True)
+        emit(':', (), False)
     ilevel += 1
 
 def leave(val = None):
     global ilevel
     ilevel -= 1
     if val is None:
-        log('<< ')
+        emit('<< ', (), False)
     else:
-        log('<< %r', val)
+        emit('<< %r', (val,), False)
     return val
 
 def xrepr(obj):
@@ -42,26 +187,41 @@ def xrepr(obj):
     return repr(obj)
 
 
-def informp(*stparams):
+def informp(*stparams, **topkwargs):
+    # trace calls at level LOG_INFO
+    t = tracer(topkwargs.get('sub', 'core'))
+
     def decorator(func):
         def wrapper(*args, **kwargs):
-            
-            txt = func.__name__
-            
-            if len(stparams) > 0:
-                txt += '[%s]' % ', '.join((xrepr(x) for x in stparams))
-                
-            argrep = [xrepr(x) for x in args] + [('%s = %r' % x) for x in kwargs.items()]
-            txt += '(%s)' % ', '.join(argrep)
 
-            enter(txt)
+            if t.level > LOG_INFO:
+                return func(*args, **kwargs)
+
+            # the messages logged by func follow the decision
+            prev = current.traced
+            current.traced = sampled(args)
+            try:
+                if not current.traced:
+                    return func(*args, **kwargs)
+
+                txt = func.__name__
+
+                if len(stparams) > 0:
+                    txt += '[%s]' % ', '.join((xrepr(x) for x in stparams))
+
+                argrep = [xrepr(x) for x in args] + [('%s = %r' % x) for x in kwargs.items()]
+                txt += '(%s)' % ', '.join(argrep)
+
+                enter(txt)
 
-            r = func(*args, **kwargs)
+                r = func(*args, **kwargs)
 
-            return leave(r)
+                return leave(r)
+            finally:
+                current.traced = prev
 
         wrapper.__name__ = func.__name__
-        if debug:
+        if t.level <= LOG_INFO:
             return wrapper
         else:
             return func
@@ -71,34 +231,50 @@ def inform(func):
     return informp()(func)
 
 def informobjp(*stparams, **topkwargs):
+    # trace method calls at level LOG_INFO; with updater = True,
+    # the state of the object before and after at level LOG_DEBUG
+    t = tracer(topkwargs.get('sub', 'obj'))
+    updater = topkwargs.get('updater', False)
+
     def decorator(func):
         def wrapper(self, *args, **kwargs):
-            
-            txt = '%s%s@%x%s.%s' % (self.__class__.__name__,
-                                    cDARK, id(self), cNORMAL,
-                                    func.__name__)
-            
-            if len(stparams) > 0:
-                txt += '[%s]' % ', '.join((xrepr(x) for x in stparams))
-                
-            argrep = [xrepr(x) for x in args] + [('%s = %r' % x) for x in kwargs.items()]
-            txt += '(%s)' % ', '.join(argrep)
 
-            enter(txt)
+            if t.level > LOG_INFO:
+                return func(self, *args, **kwargs)
+
+            prev = current.traced
+            current.traced = sampled((self,) + args)
+            try:
+                if not current.traced:
+                    return func(self, *args, **kwargs)
+
+                txt = '%s%s@%x%s.%s' % (self.__class__.__name__,
+                                        cDARK, id(self), cNORMAL,
+                                        func.__name__)
+
+                if len(stparams) > 0:
+                    txt += '[%s]' % ', '.join((xrepr(x) for x in stparams))
+
+                argrep = [xrepr(x) for x in args] + [('%s = %r' % x) for x in kwargs.items()]
+                txt += '(%s)' % ', '.join(argrep)
+
+                enter(txt)
 
-            if topkwargs.get('updater',False) and (func.__name__ != "__init__"):
-                # no state prior to init
-                log("%sobject before:%s %s", cRED, cNORMAL, self) 
+                if updater and t.on and (func.__name__ != "__init__"):
+                    # no state prior to init
+                    emit("%sobject before:%s %s", (cRED, cNORMAL, self), False)
 
-            r = func(self, *args, **kwargs)
+                r = func(self, *args, **kwargs)
 
-            if topkwargs.get('updater',False):
-                log("%sobject after: %s %s", cRED, cNORMAL, self) 
+                if updater and t.on:
+                    emit("%sobject after: %s %s", (cRED, cNORMAL, self), False)
 
-            return leave(r)
+                return leave(r)
+            finally:
+                current.traced = prev
 
         wrapper.__name__ = func.__name__
-        if debug:
+        if t.level <= LOG_INFO:
             return wrapper
         else:
             return func
@@ -108,14 +284,59 @@ def informobj(func):
     return informobjp()(func)
 
 if __name__ == "__main__":
-    debug = True
+    setTrace('*', LOG_DEBUG)
     log("hello", more=True)
     log(" world")
     log(" %s %s", 'q', 'r')
-    debug = False
+    tracer('test').info("info %d", 1)
+    setTrace('core', LOG_INFO)
     log("should not see")
+    setTrace('test', LOG_WARN)
+    tracer('test').info("should not see")
+
+    setSampling(3)
+    assert [sampleNext() for i in xrange(6)] == [False, False, True] * 2
+
+    # the messages logged on behalf of an untraced record are dropped
+    import StringIO
+
+    class rec(object):
+        def __init__(self, traced):
+            self.traced = traced
+
+    @inform
+    def handle(r):
+        log("handling %r", r.traced)
+        inner()
+
+    @inform
+    def inner():
+        tracer('test').debug("inner")
+
+    setTrace('core', LOG_DEBUG)
+    setTrace('test', LOG_DEBUG)
+    stderr = sys.stderr
+    sys.stderr = out = StringIO.StringIO()
+    handle(rec(False))
+    handle(rec(True))
+    sys.stderr = stderr
+    # the traced record only: a log line, the call and the debug
+    # line of inner()
+    assert out.getvalue().count('handling') == 1
+    assert out.getvalue().count('inner') == 2
 
 __all__ = [
+    'LOG_NOTSET',
+    'LOG_DEBUG',
+    'LOG_INFO',
+    'LOG_WARN',
+    'LOG_ERROR',
+    'LOG_FATAL',
+    'LOG_OFF',
+    'tracer',
+    'setTrace',
+    'setSampling',
+    'sampleNext',
     'log',
     'enter',
     'leave',
@@ -0,0 +1,213 @@
+import os
+import sys
+import time
+import types
+import atexit
+import threading
+
+# Performance counters: per box, per synchrocell and for the waits
+# in the runtime.
+#
+# HYDRA_STATS enables them; the counters are then printed to stderr
+# at exit, and every HYDRA_STATS_INTERVAL seconds if that is set.
+# snapshot() returns them as a dict.
+#
+# Boxes are only instrumented if the counters are enabled when the
+# network is built; other call sites test "if counters.on:".
+
+config = {
+    'on' : bool(os.getenv('HYDRA_STATS')),
+    'interval' : float(os.getenv('HYDRA_STATS_INTERVAL', '0')),
+}
+
+# execution times are kept in a histogram with power-of-2 buckets
+# (in microseconds), for percentiles
+NBUCKETS = 32
+
+def bucket(dt):
+    return min(NBUCKETS - 1, int(dt * 1e6).bit_length())
+
+def percentile(hist, n, p):
+    # upper bound of the bucket holding the p-th percentile, in seconds
+    if n == 0:
+        return 0.
+    rank = n * p / 100.
+    total = 0
+    for i, k in enumerate(hist):
+        total += k
+        if total >= rank:
+            return (1 << i) / 1e6
+    return (1 << (NBUCKETS - 1)) / 1e6
+
+class BoxStats(object):
+    # calls: number of invocations (= records in)
+    # recsout: records produced
+    # time: execution time of the box function, not counting
+    #   the continuations that its outputs run inline
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.recsout = 0
+        self.time = 0.
+        self.hist = [0] * NBUCKETS
+
+    def __repr__(self):
+        return '<BoxStats %s: %d calls>' % (self.name, self.calls)
+
+    def add(self, dt, nout):
+        with self.lock:
+            self.calls += 1
+            self.recsout += nout
+            self.time += dt
+            self.hist[bucket(dt)] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'calls' : self.calls,
+                'recsin' : self.calls,
+                'recsout' : self.recsout,
+                'time' : self.time,
+                'p50' : percentile(self.hist, self.calls, 50),
+                'p90' : percentile(self.hist, self.calls, 90),
+                'p99' : percentile(self.hist, self.calls, 99),
+            }
+
+class Counters(object):
+    # named event counts and cumulated durations
+
+    def __init__(self, name):
+        self.name = name
+        self.on = config['on']
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.times = {}
+
+    def __repr__(self):
+        return '<Counters %s: %r>' % (self.name, self.counts)
+
+    def count(self, key, n = 1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + n
+
+    def addTime(self, key, dt):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.times[key] = self.times.get(key, 0.) + dt
+
+    def snapshot(self):
+        with self.lock:
+            s = dict(self.counts)
+            for k, t in self.times.items():
+                s[k + '.time'] = t
+            return s
+
+boxstats = []
+allcounters = {}
+statslock = threading.Lock()
+
+def counters(name):
+    with statslock:
+        c = allcounters.get(name)
+        if c is None:
+            c = allcounters[name] = Counters(name)
+        return c
+
+def countBox(f):
+    # instrument a box function, if the counters are enabled
+    if not config['on']:
+        return f
+
+    st = BoxStats('%s#%d' % (f.__name__, len(boxstats)))
+    with statslock:
+        boxstats.append(st)
+
+    def countf(outf, rec):
+        d = [0, 0.]
+
+        def countout(r):
+            # the continuation is not part of the box's time
+            start = time.time()
+            outf(r)
+            d[0] += 1
+            d[1] += time.time() - start
+
+        start = time.time()
+        res = f(countout, rec)
+        if isinstance(res, types.GeneratorType):
+            # a coroutine box: count when it has finished
+            return countgen(st, res, start, d)
+        st.add(time.time() - start - d[1], d[0])
+        return res
+
+    countf.__name__ = f.__name__
+    countf.__dict__.update(f.__dict__)
+    return countf
+
+def countgen(st, gen, start, d):
+    yield gen
+    st.add(time.time() - start - d[1], d[0])
+
+def snapshot():
+    # all the counters, as a dict
+    with statslock:
+        boxes = list(boxstats)
+        cs = allcounters.items()
+    return {
+        'boxes' : dict(((st.name, st.snapshot()) for st in boxes)),
+        'counters' : dict(((name, c.snapshot()) for name, c in cs)),
+    }
+
+def dumpStats(f = None):
+    if f is None:
+        f = sys.stderr
+    s = snapshot()
+    for name, b in sorted(s['boxes'].items()):
+        f.write('box %-20s calls %8d out %8d time %9.3fs p50 %8.1fus p90 %8.1fus p99 %8.1fus\n' % (
+            name, b['calls'], b['recsout'], b['time'],
+            b['p50'] * 1e6, b['p90'] * 1e6, b['p99'] * 1e6))
+    for name, c in sorted(s['counters'].items()):
+        f.write('%-24s %s\n' % (name, ' '.join(('%s %s' % (k, v) for k, v in sorted(c.items())))))
+    f.flush()
+
+def dumper():
+    while True:
+        time.sleep(config['interval'])
+        dumpStats()
+
+def startDumper():
+    t = threading.Thread(target = dumper, name = 'hydra-stats')
+    t.daemon = True
+    t.start()
+
+def configureStats(on = None, interval = None):
+    # the counters of boxes are only kept for networks built
+    # after they are enabled
+    if on is not None:
+        config['on'] = on
+        for c in allcounters.values():
+            c.on = on
+    if interval is not None:
+        previous = config['interval']
+        config['interval'] = interval
+        if previous == 0 and interval > 0:
+            startDumper()
+
+if config['interval'] > 0:
+    startDumper()
+
+def dumpAtExit():
+    if config['on']:
+        dumpStats()
+
+atexit.register(dumpAtExit)
+
+__all__ = [
+    'countBox',
+    'counters',
+    'snapshot',
+    'dumpStats',
+    'configureStats'
+]
@@ -0,0 +1,259 @@
+import os
+import sys
+import stat
+import mmap
+import time
+import json
+import struct
+import atexit
+import threading
+
+# --------- bulk input -------
+
+config = {
+    # bytes read per system call
+    'chunksize' : int(os.getenv('HYDRA_CHUNKSIZE', str(1 << 20))),
+    # record delimiter, kept at the end of each record like readline() does
+    'delim' : os.getenv('HYDRA_DELIM', '\\n').decode('string_escape'),
+}
+
+def configureInput(chunksize = None, delim = None):
+    if chunksize is not None:
+        assert chunksize > 0
+        config['chunksize'] = chunksize
+    if delim is not None:
+        assert len(delim) > 0
+        config['delim'] = delim
+
+def readBatches(f = None):
+    # generate the input records in batches (lists of strings).
+    # Regular files are mapped in memory, anything else is read in
+    # chunks of config['chunksize'] bytes.
+    if f is None:
+        f = sys.stdin
+    fd = f.fileno()
+
+    st = os.fstat(fd)
+    if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+        return mapBatches(fd, st.st_size)
+    return chunkBatches(fd)
+
+class RecordSplitter(object):
+    # cuts a sequence of chunks into records; the incomplete
+    # record at the end of a chunk is kept for the next one.
+
+    def __init__(self):
+        self.chunksize = config['chunksize']
+        self.delim = config['delim']
+        self.tail = ''
+
+    def feed(self, chunk):
+        delim = self.delim
+        parts = (self.tail + chunk).split(delim)
+        self.tail = parts.pop()
+        return [p + delim for p in parts]
+
+    def finish(self):
+        tail, self.tail = self.tail, ''
+        if tail != '':
+            return [tail]
+        return []
+
+def chunkBatches(fd):
+    sp = RecordSplitter()
+    while True:
+        chunk = os.read(fd, sp.chunksize)
+        if chunk == '':
+            break
+        batch = sp.feed(chunk)
+        if len(batch) > 0:
+            yield batch
+    batch = sp.finish()
+    if len(batch) > 0:
+        yield batch
+
+def mapBatches(fd, size):
+    # the same records as chunkBatches(), cut from chunks of the map
+    # of the file instead of chunks read from it. The map starts at
+    # offset 0, the input at the current offset of fd: what was read
+    # from it already is skipped.
+    sp = RecordSplitter()
+    start = os.lseek(fd, 0, os.SEEK_CUR)
+    m = mmap.mmap(fd, size, access = mmap.ACCESS_READ)
+    try:
+        for offset in xrange(start, size, sp.chunksize):
+            batch = sp.feed(m[offset:offset + sp.chunksize])
+            if len(batch) > 0:
+                yield batch
+    finally:
+        m.close()
+    batch = sp.finish()
+    if len(batch) > 0:
+        yield batch
+
+# --------- buffered output -------
+
+# serializers: record -> string written to the output
+
+def serializeRepr(rec):
+    # what "print record" used to write
+    return '%s\n' % (rec,)
+
+def serializeStr(rec):
+    # the raw 'str' field, one per line
+    s = rec['str']
+    if not s.endswith('\n'):
+        s += '\n'
+    return s
+
+def serializeJson(rec):
+    # JSON lines
+    return json.dumps(rec, sort_keys = True) + '\n'
+
+def serializeFrame(rec):
+    # binary frame: total length, then for each field the
+    # length-prefixed name and value, all lengths big-endian.
+    parts = []
+    for k, v in sorted(rec.items()):
+        v = str(v)
+        parts.append(struct.pack('>H', len(k)))
+        parts.append(k)
+        parts.append(struct.pack('>I', len(v)))
+        parts.append(v)
+    body = ''.join(parts)
+    return struct.pack('>I', len(body)) + body
+
+serializers = {
+    'repr' : serializeRepr,
+    'str' : serializeStr,
+    'json' : serializeJson,
+    'frame' : serializeFrame,
+}
+
+class OutputSink(object):
+    # Write-behind buffer for the output records. The buffer is
+    # flushed when it holds bufsize bytes, and by a background thread
+    # when its oldest data is flushinterval seconds old.
+
+    def __init__(self, f, serializer, bufsize, flushinterval):
+        self.f = f
+        self.serialize = serializer
+        self.bufsize = bufsize
+        self.flushinterval = flushinterval
+        self.lock = threading.Lock()
+        self.buf = []
+        self.size = 0
+        self.since = None
+
+        if flushinterval > 0:
+            t = threading.Thread(target = self.flusher, name = 'hydra-flusher')
+            t.daemon = True
+            t.start()
+
+    def __repr__(self):
+        return '<OutputSink %s, %d bytes buffered>' % (self.serialize.__name__, self.size)
+
+    def write(self, rec):
+        data = self.serialize(rec)
+        with self.lock:
+            self.buf.append(data)
+            self.size += len(data)
+            if self.since is None:
+                self.since = time.time()
+            if self.size >= self.bufsize:
+                self.flushLocked()
+
+    def flush(self):
+        with self.lock:
+            self.flushLocked()
+
+    def flushLocked(self):
+        if self.size > 0:
+            self.f.write(''.join(self.buf))
+            del self.buf[:]
+            self.size = 0
+        self.since = None
+        self.f.flush()
+
+    def flusher(self):
+        while True:
+            time.sleep(self.flushinterval)
+            with self.lock:
+                if self.since is not None and time.time() - self.since >= self.flushinterval:
+                    self.flushLocked()
+
+outconfig = {
+    'serializer' : os.getenv('HYDRA_OUTPUT', 'repr'),
+    'bufsize' : int(os.getenv('HYDRA_OUTBUF', str(1 << 16))),
+    'flushinterval' : float(os.getenv('HYDRA_FLUSHMS', '100')) / 1000.,
+}
+
+sink = None
+
+def configureOutput(serializer = None, bufsize = None, flushinterval = None):
+    # serializer: one of the names in serializers, or a function.
+    global sink
+    if serializer is not None:
+        outconfig['serializer'] = serializer
+    if bufsize is not None:
+        outconfig['bufsize'] = bufsize
+    if flushinterval is not None:
+        outconfig['flushinterval'] = flushinterval
+    if sink is not None:
+        sink.flush()
+        sink = None
+
+def outputSink():
+    global sink
+    if sink is None:
+        ser = outconfig['serializer']
+        if not callable(ser):
+            ser = serializers[ser]
+        sink = OutputSink(sys.stdout, ser, outconfig['bufsize'], outconfig['flushinterval'])
+    return sink
+
+def flushOutput():
+    if sink is not None:
+        sink.flush()
+
+atexit.register(flushOutput)
+
+if __name__ == "__main__":
+    import tempfile
+
+    # a file gives the same records as a pipe, whatever the chunk size,
+    # including with a delimiter that can overlap itself
+    data = 'x' * 5 + '\n\n\n' + 'y' + '\n\n' * 3 + 'zz\n\n\n\n\nw'
+    for delim in ('\n', '\n\n', 'xx'):
+        for chunksize in (1, 2, 3, 5, 8, 13, 100):
+            configureInput(chunksize = chunksize, delim = delim)
+            expected = [p + delim for p in data.split(delim)]
+            expected[-1] = expected[-1][:-len(delim)]
+
+            with tempfile.TemporaryFile() as f:
+                f.write(data)
+                f.flush()
+                f.seek(0)
+                mapped = sum(mapBatches(f.fileno(), len(data)), [])
+                # what was consumed already is skipped
+                os.lseek(f.fileno(), 6, os.SEEK_SET)
+                skipped = sum(mapBatches(f.fileno(), len(data)), [])
+
+            r, w = os.pipe()
+            os.write(w, data)
+            os.close(w)
+            piped = sum(chunkBatches(r), [])
+            os.close(r)
+
+            assert mapped == piped == expected, (delim, chunksize, mapped, piped)
+            assert ''.join(skipped) == data[6:]
+    print 'ok'
+
+__all__ = [
+    'configureInput',
+    'readBatches',
+    'RecordSplitter',
+    'configureOutput',
+    'outputSink',
+    'flushOutput'
+]
@@ -0,0 +1,41 @@
+import functools
+
+# Tail calls between continuations.
+#
+# A function decorated with @handletc may return tailcall(f, args...)
+# instead of calling f(args...) itself: the decorator then runs the
+# call in a loop, so that a chain of continuations runs at constant
+# stack depth. When f is itself decorated with @handletc, the loop
+# calls the undecorated function directly instead of nesting another
+# loop.
+#
+# tailcall is a functools.partial, so creating and dispatching a tail
+# call does not execute any python code besides the loop below.
+#
+# This is a trampoline rather than a scheduler with a work queue: a
+# continuation returns at most one tail call, so such a queue would
+# never hold more than one entry, and the returned value already plays
+# that role. Work that can proceed independently (the other outputs of
+# a box) is handed to the worker threads by insertContainer(); queuing
+# it behind the current chain instead could deadlock, as that chain
+# may wait for it in handleOutput (see workers.ThreadPool).
+
+class tailcall(functools.partial):
+    __slots__ = ()
+
+def handletc(func):
+    def wrapper(*args):
+        r = func(*args)
+        while type(r) is tailcall:
+            f = r.func
+            r = getattr(f, 'tcinner', f)(*r.args)
+        return r
+
+    wrapper.tcinner = func
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+__all__ = [
+    'tailcall',
+    'handletc'
+]
@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+
+# Offline analysis of the trace events recorded with HYDRA_EVENTS.
+#
+#   # list the events
+#   python tracetool.py dump <file>
+#
+#   # latency from input to the last output, over the input records
+#   python tracetool.py latency <file>
+#
+#   # time spent in each box; without worker threads, this includes
+#   # the continuations of all its outputs but the last one
+#   python tracetool.py boxes <file>
+#
+#   # what happened to some input records, box by box
+#   python tracetool.py timeline <file> <record number>...
+
+import sys
+from events import readEvents, opnames, EV_NAME, EV_INPUT, EV_BOXIN, EV_BOXOUT, EV_OUTPUT
+
+def loadTrace(path):
+    # the events, sorted by time, and the box names
+    names = {}
+    events = []
+    with open(path, 'rb') as f:
+        for ev in readEvents(f):
+            if ev[1] == EV_NAME:
+                names[ev[6]] = ev[7]
+            else:
+                events.append(ev)
+    events.sort(key = lambda ev: ev[0])
+    return events, names
+
+def boxName(names, boxid):
+    # the same box function can appear several times in a network
+    return '%s#%d' % (names.get(boxid, '?'), boxid)
+
+def percentile(values, p):
+    # values must be sorted
+    if len(values) == 0:
+        return 0.
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+def summary(values):
+    values = sorted(values)
+    return 'n %7d  mean %9.1fus  p50 %9.1fus  p90 %9.1fus  p99 %9.1fus  max %9.1fus' % (
+        len(values),
+        sum(values) / max(1, len(values)) * 1e6,
+        percentile(values, 50) * 1e6,
+        percentile(values, 90) * 1e6,
+        percentile(values, 99) * 1e6,
+        values[-1] * 1e6 if len(values) > 0 else 0.)
+
+def boxSpans(events):
+    # pair each EV_BOXIN with the next EV_BOXOUT of the same box and
+    # input record: (boxid, inseq, start, end)
+    started = {}
+    spans = []
+    for t, op, cid, inseq, pos, pli, arg in events:
+        if op == EV_BOXIN:
+            started.setdefault((arg, inseq), []).append(t)
+        elif op == EV_BOXOUT:
+            starts = started.get((arg, inseq))
+            if starts:
+                spans.append((arg, inseq, starts.pop(0), t))
+    return spans
+
+def dump(events, names):
+    t0 = events[0][0] if len(events) > 0 else 0
+    for t, op, cid, inseq, pos, pli, arg in events:
+        print '%12.6f %-8s %016x rec %6d pos %5d pli %5d %s' % (
+            t - t0, opnames[op], cid, inseq, pos, pli,
+            names.get(arg, '') if op in (EV_BOXIN, EV_BOXOUT) else '')
+
+def latency(events, names):
+    inputs = {}
+    outputs = {}
+    for t, op, cid, inseq, pos, pli, arg in events:
+        if op == EV_INPUT:
+            inputs[inseq] = t
+        elif op == EV_OUTPUT:
+            outputs[inseq] = t
+
+    lat = [(outputs[n] - inputs[n], n) for n in outputs if n in inputs]
+    print 'input to last output:', summary([l for l, n in lat])
+    print 'records without output: %d' % (len(inputs) - len(lat))
+    print 'slowest records:'
+    for l, n in sorted(lat, reverse = True)[:10]:
+        print '  rec %6d  %9.1fus' % (n, l * 1e6)
+
+def boxes(events, names):
+    times = {}
+    for boxid, inseq, start, end in boxSpans(events):
+        times.setdefault(boxid, []).append(end - start)
+    for boxid in sorted(times):
+        print '%-20s %s' % (boxName(names, boxid), summary(times[boxid]))
+
+def timeline(events, names, recs):
+    spans = boxSpans(events)
+    for n in recs:
+        evs = [ev for ev in events if ev[3] == n]
+        if len(evs) == 0:
+            print 'rec %d: no events' % n
+            continue
+        t0 = evs[0][0]
+        lines = []
+        for t, op, cid, inseq, pos, pli, arg in evs:
+            if op not in (EV_BOXIN, EV_BOXOUT):
+                lines.append((t, '%-20s %016x pos %5d pli %5d' % (opnames[op], cid, pos, pli)))
+        for boxid, inseq, start, end in spans:
+            if inseq == n:
+                lines.append((start, '%-20s %9.1fus' % (boxName(names, boxid), (end - start) * 1e6)))
+        print 'rec %d:' % n
+        for t, txt in sorted(lines):
+            print '  %+10.1fus %s' % ((t - t0) * 1e6, txt)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print >>sys.stderr, "usage:", sys.argv[0], "dump|latency|boxes|timeline <file> [<record>...]"
+        sys.exit(1)
+
+    events, names = loadTrace(sys.argv[2])
+    cmd = sys.argv[1]
+    if cmd == 'dump':
+        dump(events, names)
+    elif cmd == 'latency':
+        latency(events, names)
+    elif cmd == 'boxes':
+        boxes(events, names)
+    elif cmd == 'timeline':
+        timeline(events, names, [int(x) for x in sys.argv[3:]])
+    else:
+        print >>sys.stderr, "unknown command:", cmd
+        sys.exit(1)
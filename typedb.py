@@ -0,0 +1,263 @@
+import mmap
+import ctypes
+import atexit
+import threading
+
+# The concrete type database (see docs/langif.rst, "Concrete type
+# database").
+#
+# It maps the type id of each field to the functions that manage its
+# data. A box language registers itself with regLang(), with the
+# functions that (de)serialize its types, then its types:
+#
+# - regEmaType(): environment-managed types, whose data the field
+#   database allocates, clones and deallocates through the type;
+# - regLmaType(): language-managed types, whose data is allocated by
+#   the language and reference counted by it; the field database
+#   only captures it with wrap().
+#
+# Language 0 is the common data language, with the predefined BYTES_*
+# types. They are buffers, and serialize to themselves.
+#
+# All the callbacks take the context returned by the init() of their
+# language first. The (de)serialization functions can be called
+# concurrently and must do their own locking if needed.
+
+COMMON_LANG = 0
+
+# predefined concrete types of the common data language
+BYTES_UNALIGNED = 0
+BYTES_SCALAR_ALIGNED = 1
+BYTES_CACHE_ALIGNED = 2
+BYTES_PAGE_ALIGNED = 3
+
+class LangCB(object):
+    # the callbacks of a language (struct lang_cb), all optional:
+    #   init() -> (status, langctx); a non-zero status refuses the language
+    #   cleanup(langctx)
+    #   getsersize(langctx, typeid, objsize, data)
+    #     -> conservative estimate of the serialized size
+    #   serialize(langctx, typeid, objsize, data, dstbuf)
+    #     -> the number of bytes written in dstbuf, a writable
+    #        memoryview of getsersize() bytes, or -1 on failure
+    #   getdesersize(langctx, typeid, srcbuf)
+    #     -> conservative estimate of the object size
+    #   deserialize(langctx, typeid, srcbuf, data) -> (data, objsize)
+    #     data is preallocated with getdesersize() bytes, or None
+    #     without getdesersize; it can be replaced by a new object.
+    # objsize is 0 for language-managed types.
+
+    def __init__(self, init = None, cleanup = None, getsersize = None, serialize = None,
+                 getdesersize = None, deserialize = None):
+        self.init = init
+        self.cleanup = cleanup
+        self.getsersize = getsersize
+        self.serialize = serialize
+        self.getdesersize = getdesersize
+        self.deserialize = deserialize
+
+class EmaTypeCB(object):
+    # the callbacks of an environment-managed type (struct ema_type_cb):
+    #   allocate(langctx, typeid, size) -> (data, realsize)
+    #   deallocate(langctx, typeid, size, data)
+    #   clone(langctx, typeid, size, data) -> data
+
+    def __init__(self, allocate, deallocate, clone):
+        self.allocate = allocate
+        self.deallocate = deallocate
+        self.clone = clone
+
+class LmaTypeCB(object):
+    # the callbacks of a language-managed type (struct lma_type_cb):
+    #   incref(langctx, typeid, data)
+    #   decref(langctx, typeid, data) -> 1 if it was the last reference
+    #   getsize(langctx, typeid, data) -> size in memory, for monitoring
+
+    def __init__(self, incref, decref, getsize):
+        self.incref = incref
+        self.decref = decref
+        self.getsize = getsize
+
+class Language(object):
+
+    def __init__(self, langid, name, cb, ctx):
+        self.langid = langid
+        self.name = name
+        self.cb = cb
+        self.ctx = ctx
+
+    def __repr__(self):
+        return '<Language %d %s>' % (self.langid, self.name)
+
+class ConcreteType(object):
+    # a registered type: ema or lma is set. buffered: the data is a
+    # buffer, accessed through a memoryview (see fields.py)
+
+    def __init__(self, lang, typeid, name, ema, lma, buffered):
+        self.lang = lang
+        self.typeid = typeid
+        self.name = name
+        self.ema = ema
+        self.lma = lma
+        self.buffered = buffered
+
+    def __repr__(self):
+        return '<ConcreteType %d %s (%s, %s)>' % (self.typeid, self.name, self.lang.name,
+                                                 ['lma', 'ema'][self.ema is not None])
+
+    # EMA
+    def allocate(self, size):
+        return self.ema.allocate(self.lang.ctx, self.typeid, size)
+
+    def deallocate(self, size, data):
+        self.ema.deallocate(self.lang.ctx, self.typeid, size, data)
+
+    def clone(self, size, data):
+        return self.ema.clone(self.lang.ctx, self.typeid, size, data)
+
+    # LMA
+    def incref(self, data):
+        self.lma.incref(self.lang.ctx, self.typeid, data)
+
+    def decref(self, data):
+        return self.lma.decref(self.lang.ctx, self.typeid, data)
+
+    # serialization
+    def getsersize(self, size, data):
+        return self.lang.cb.getsersize(self.lang.ctx, self.typeid, size, data)
+
+    def serialize(self, size, data, dstbuf):
+        return self.lang.cb.serialize(self.lang.ctx, self.typeid, size, data, dstbuf)
+
+    def getdesersize(self, srcbuf):
+        if self.lang.cb.getdesersize is None:
+            return None
+        return self.lang.cb.getdesersize(self.lang.ctx, self.typeid, srcbuf)
+
+    def deserialize(self, srcbuf, data):
+        return self.lang.cb.deserialize(self.lang.ctx, self.typeid, srcbuf, data)
+
+langs = []
+typetable = {}
+reglock = threading.Lock()
+
+def regLang(langmgr, name):
+    # register a language, -> its id. Its init() is called now.
+    ctx = None
+    if langmgr.init is not None:
+        status, ctx = langmgr.init()
+        if status != 0:
+            raise RuntimeError('language %s failed to initialize (%d)' % (name, status))
+    with reglock:
+        lang = Language(len(langs), name, langmgr, ctx)
+        langs.append(lang)
+    return lang.langid
+
+def regType(langid, typeid, name, ema = None, lma = None, buffered = False):
+    with reglock:
+        if typeid in typetable:
+            raise ValueError('type %d already registered as %r' % (typeid, typetable[typeid]))
+        typetable[typeid] = ConcreteType(langs[langid], typeid, name, ema, lma, buffered)
+
+def regEmaType(langid, typeid, name, tcb, buffered = False):
+    regType(langid, typeid, name, ema = tcb, buffered = buffered)
+
+def regLmaType(langid, typeid, name, tcb):
+    regType(langid, typeid, name, lma = tcb)
+
+def concreteType(typeid):
+    # the ConcreteType of typeid, or None
+    return typetable.get(typeid)
+
+def cleanupLangs():
+    for lang in reversed(langs):
+        if lang.cb.cleanup is not None:
+            lang.cb.cleanup(lang.ctx)
+
+atexit.register(cleanupLangs)
+
+# --------- the common data language -------
+
+def bufferView(data):
+    # a memoryview of a buffer, without copying it
+    if type(data) is memoryview:
+        return data
+    try:
+        return memoryview(data)
+    except TypeError:
+        # mmap objects only have the old buffer interface
+        if not isinstance(data, mmap.mmap):
+            raise
+        try:
+            return memoryview((ctypes.c_char * len(data)).from_buffer(data))
+        except TypeError:
+            # read-only map
+            return memoryview(buffer(data))
+
+def alignedBuffer(size, align):
+    # a ctypes char array of size bytes at an address multiple of align
+    if align >= mmap.PAGESIZE:
+        # anonymous maps start on a page boundary; the pages are
+        # unmapped when the last view of the array is gone
+        return (ctypes.c_char * size).from_buffer(mmap.mmap(-1, size))
+    raw = bytearray(size + align - 1)
+    addr = ctypes.addressof((ctypes.c_char * len(raw)).from_buffer(raw))
+    return (ctypes.c_char * size).from_buffer(raw, -addr % align)
+
+def bytesType(align):
+    # byte buffers aligned on align, the allocated size rounded up to it
+    def allocate(ctx, typeid, size):
+        realsize = max(align, (size + align - 1) // align * align)
+        return alignedBuffer(realsize, align), realsize
+
+    def deallocate(ctx, typeid, size, data):
+        # the memory goes with the last view of data, there can be
+        # some left in fields wrapping a slice
+        pass
+
+    def clone(ctx, typeid, size, data):
+        # data: any buffer (str, bytearray, memoryview, ...), of which
+        # the first size bytes are copied
+        c, realsize = allocate(ctx, typeid, size)
+        memoryview(c)[:size] = bufferView(data)[:size]
+        return c
+
+    return EmaTypeCB(allocate, deallocate, clone)
+
+def bytesSersize(ctx, typeid, objsize, data):
+    return objsize
+
+def bytesSerialize(ctx, typeid, objsize, data, dstbuf):
+    dstbuf[:objsize] = bufferView(data)[:objsize]
+    return objsize
+
+def bytesDesersize(ctx, typeid, srcbuf):
+    return len(srcbuf)
+
+def bytesDeserialize(ctx, typeid, srcbuf, data):
+    if data is None:
+        data = bytearray(len(srcbuf))
+    bufferView(data)[:len(srcbuf)] = srcbuf
+    return data, len(srcbuf)
+
+regLang(LangCB(getsersize = bytesSersize, serialize = bytesSerialize,
+               getdesersize = bytesDesersize, deserialize = bytesDeserialize), 'common')
+regEmaType(COMMON_LANG, BYTES_UNALIGNED, 'bytes', bytesType(1), buffered = True)
+regEmaType(COMMON_LANG, BYTES_SCALAR_ALIGNED, 'bytes/scalar', bytesType(16), buffered = True)
+regEmaType(COMMON_LANG, BYTES_CACHE_ALIGNED, 'bytes/cache', bytesType(64), buffered = True)
+regEmaType(COMMON_LANG, BYTES_PAGE_ALIGNED, 'bytes/page', bytesType(mmap.PAGESIZE), buffered = True)
+
+__all__ = [
+    'COMMON_LANG',
+    'BYTES_UNALIGNED',
+    'BYTES_SCALAR_ALIGNED',
+    'BYTES_CACHE_ALIGNED',
+    'BYTES_PAGE_ALIGNED',
+    'LangCB',
+    'EmaTypeCB',
+    'LmaTypeCB',
+    'regLang',
+    'regEmaType',
+    'regLmaType',
+    'concreteType'
+]
@@ -0,0 +1,245 @@
+import os
+import sys
+import time
+import atexit
+import threading
+import traceback
+import Queue
+import multiprocessing
+from stats import counters
+from fields import cleanupBox, packRecs, unpackRecs, releaseRec
+
+# --------- thread pool for continuations -------
+
+class WorkerFailed(Exception):
+    # raised in the threads that wait for the results of a task that
+    # failed in a worker thread (see onWorkerFailure), so that they
+    # give up instead of waiting forever.
+    pass
+
+# called in a worker thread after a task raised an exception
+failurehooks = []
+
+def onWorkerFailure(f):
+    failurehooks.append(f)
+
+class ThreadPool(object):
+    # A fixed set of worker threads.
+    #
+    # Work is only handed over to a worker that is idle right now;
+    # when all workers are busy, trySubmit() returns False and the
+    # caller must run the work inline. This way a submitted task never
+    # waits in a queue behind a task that (transitively) waits for it
+    # in handleOutput, so the pool cannot deadlock.
+
+    def __init__(self, nthreads):
+        assert nthreads > 0
+        self.nthreads = nthreads
+        self.tasks = Queue.Queue()
+        self.lock = threading.Lock()
+        self.quiet = threading.Condition(self.lock)
+        self.idle = 0
+        self.pending = 0
+        self.errors = []
+        self.threads = []
+        # submitted/inline: work handed over or run by the caller,
+        # queue: time between submission and start
+        self.counters = counters('threads')
+
+        for i in xrange(nthreads):
+            t = threading.Thread(target = self.worker, name = 'hydra-worker-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def __repr__(self):
+        return '<ThreadPool %d threads, %d idle, %d pending>' % (self.nthreads, self.idle, self.pending)
+
+    def worker(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            func, args, queued = self.tasks.get()
+            if func is None:
+                return
+            if self.counters.on:
+                self.counters.addTime('queue', time.time() - queued)
+            try:
+                func(*args)
+            except WorkerFailed:
+                # the consequence of an error recorded already
+                pass
+            except:
+                traceback.print_exc()
+                self.errors.append(sys.exc_info()[1])
+                for f in failurehooks:
+                    f()
+            with self.lock:
+                self.pending -= 1
+                if self.pending == 0:
+                    self.quiet.notify_all()
+
+    def trySubmit(self, func, *args):
+        with self.lock:
+            if self.idle == 0:
+                if self.counters.on:
+                    self.counters.count('inline')
+                return False
+            self.idle -= 1
+            self.pending += 1
+        if self.counters.on:
+            self.counters.count('submitted')
+        self.tasks.put((func, args, time.time()))
+        return True
+
+    def wait(self):
+        # wait until all submitted tasks have completed, then raise
+        # the first error of a task if there was one
+        with self.lock:
+            while self.pending > 0:
+                self.quiet.wait()
+        if len(self.errors) > 0:
+            e = self.errors[0]
+            del self.errors[:]
+            raise e
+
+    def shutdown(self):
+        # stop the worker threads once they are idle
+        for t in self.threads:
+            self.tasks.put((None, None, None))
+        for t in self.threads:
+            t.join()
+
+# --------- process pool for box functions -------
+
+def runBox(f, packed):
+    # executed in a pool process: run the box function
+    # to completion and ship all its outputs back at once.
+    # The fields of the records travel packed in one buffer
+    # (see packRecs), and are released here once packed.
+    rec, = unpackRecs(*packed)
+    outs = []
+    cleanupBox(f)(outs.append, rec)
+    packed = packRecs(outs)
+    for r in outs:
+        releaseRec(r)
+    return packed
+
+def cpubound(f):
+    # declare a box function as CPU-bound: when a process pool is
+    # configured, its invocations are executed there instead of in
+    # the calling thread. The function and the records it receives
+    # and produces must be picklable.
+    #
+    # The calling thread waits for the result, so the boxes only run
+    # in parallel from several threads: with a process pool there is
+    # at least one worker thread per process (see threadPool).
+    f.cpubound = True
+    return f
+
+def offloadBox(f):
+    # wrap a box function so that it runs in the process pool
+    # if it is CPU-bound and a process pool is configured.
+    if not getattr(f, 'cpubound', False):
+        return f
+
+    def procf(outf, rec):
+        if config['processes'] == 0:
+            return f(outf, rec)
+        for r in unpackRecs(*processPool().apply(runBox, (f, packRecs([rec])))):
+            # outf takes its own references to the fields
+            outf(r)
+            releaseRec(r)
+
+    procf.__name__ = f.__name__
+    return procf
+
+# --------- configuration -------
+
+config = {
+    'threads' : int(os.getenv('HYDRA_THREADS', '0')),
+    'processes' : int(os.getenv('HYDRA_PROCS', '0')),
+}
+
+threadpool = None
+procpool = None
+
+def configureWorkers(threads = None, processes = None):
+    # (re)configure the number of worker threads/processes.
+    # 0 means "run everything inline in the calling thread".
+    # The pool processes are started here, so call it once the box
+    # functions are defined (see processPool).
+    global threadpool, procpool
+    if threads is not None and threads != config['threads']:
+        if threadpool is not None:
+            threadpool.wait()
+            threadpool.shutdown()
+            threadpool = None
+        config['threads'] = threads
+    if processes is not None and processes != config['processes']:
+        if procpool is not None:
+            procpool.close()
+            procpool.join()
+            procpool = None
+        if threadpool is not None:
+            # the number of threads follows (see threadPool)
+            threadpool.wait()
+            threadpool.shutdown()
+            threadpool = None
+        config['processes'] = processes
+        if processes > 0:
+            processPool()
+
+def threadPool():
+    global threadpool
+    if threadpool is None:
+        nthreads = config['threads']
+        if config['processes'] > 0:
+            # enough threads to keep all the processes busy
+            nthreads = max(nthreads, config['processes'])
+            # fork the pool processes before starting the threads
+            processPool()
+        if nthreads > 0:
+            threadpool = ThreadPool(nthreads)
+    return threadpool
+
+def processPool():
+    # created by configureWorkers(), or by threadPool() when the
+    # network starts (for HYDRA_PROCS), so that the pool processes
+    # inherit all the box functions defined so far. Either way before
+    # the worker threads start: forking while one of them holds a lock
+    # (listlock, fielddb.lock, ...) would leave it held forever in the
+    # pool processes.
+    global procpool
+    if procpool is None:
+        procpool = multiprocessing.Pool(config['processes'])
+    return procpool
+
+def trySpawn(func, *args):
+    p = threadPool()
+    if p is None:
+        return False
+    return p.trySubmit(func, *args)
+
+def waitWorkers():
+    if threadpool is not None:
+        threadpool.wait()
+
+def shutdownWorkers():
+    global threadpool
+    if threadpool is not None:
+        threadpool.shutdown()
+        threadpool = None
+
+atexit.register(shutdownWorkers)
+
+__all__ = [
+    'ThreadPool',
+    'WorkerFailed',
+    'onWorkerFailure',
+    'cpubound',
+    'offloadBox',
+    'configureWorkers',
+    'trySpawn',
+    'waitWorkers'
+]